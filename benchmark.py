@@ -0,0 +1,281 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""Benchmarks for the python-timbl wrapper.
+
+Generates synthetic datasets and measures training, saving, loading, single
+classification latency, threaded classification throughput, testing and peak
+memory use, for several TiMBL algorithms and input formats. Results are written
+as JSON; two result files can be compared to catch performance regressions::
+
+    python benchmark.py run --output baseline.json
+    python benchmark.py run --output current.json
+    python benchmark.py compare baseline.json current.json
+"""
+
+import sys
+import os
+import io
+import json
+import time
+import random
+import shutil
+import tempfile
+import platform
+import argparse
+import resource
+import multiprocessing
+from threading import Thread
+
+import timbl
+
+#name: (instances, features, cardinality, classes)
+DATASETS = {
+    'small': (2000, 10, 5, 3),
+    'medium': (20000, 20, 20, 10),
+    'wide': (5000, 100, 2, 5),
+    'large': (100000, 10, 50, 20),
+}
+
+ALGORITHMS = {
+    'IB1': "-a 0 -k 1",
+    'IGTREE': "-a 1",
+    'TRIBL': "-a 2 -q 2",
+}
+
+FORMATS = ('Tabbed', 'Columns', 'Sparse')
+
+#metrics for which higher is better, for all others lower is better
+HIGHERISBETTER = ('threaded_throughput', 'accuracy')
+
+
+def generate(instances, features, cardinality, classes, format, seed=0):
+    """Generates a synthetic dataset, returns a list of (features, classlabel) pairs. The class depends on the first few features plus some noise, so the data has structure to learn. For the Sparse format, about a tenth of the features is set on each instance."""
+    rng = random.Random(seed)
+    data = []
+    for _ in range(instances):
+        values = [ rng.randrange(cardinality) for _ in range(features) ]
+        cls = (sum(values[:3]) + (rng.randrange(classes) if rng.random() < 0.1 else 0)) % classes
+        if format == 'Sparse':
+            active = [ i for i in range(features) if i < 3 or rng.random() < 0.1 ]
+            instance = tuple( "(%d,%d)" % (i + 1, values[i] + 1) for i in active )
+        else:
+            instance = tuple( "f%dv%d" % (i, value) for i, value in enumerate(values) )
+        data.append( (instance, "c%d" % cls) )
+    return data
+
+
+def peakrss():
+    """Peak resident set size of the calling process, in kilobytes"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024 #bytes rather than kilobytes
+    return rss
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def repeated(items, count):
+    """Yields count items, cycling through the given ones"""
+    for i in range(count):
+        yield items[i % len(items)]
+
+
+def timed(function, *args, **kwargs):
+    """Calls the function, returns (seconds, result)"""
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def runconfiguration(workdir, dataset, format, algorithm, queries, threads, seed):
+    """Runs all measurements for one dataset, format and algorithm, returns a dictionary of metrics. Should run in its own process, so the peak memory use is its own"""
+    instances, features, cardinality, classes = DATASETS[dataset]
+    data = generate(instances, features, cardinality, classes, format, seed)
+    split = len(data) * 9 // 10
+    train, test = data[:split], data[split:]
+    fileprefix = os.path.join(workdir, "%s-%s-%s" % (dataset, format, algorithm))
+    options = ALGORITHMS[algorithm]
+    metrics = {}
+
+    classifier = timbl.TimblClassifier(fileprefix, options, format=format, flushthreshold=len(train) + 1)
+    metrics['append'], _ = timed(lambda: [ classifier.append(features, cls) for features, cls in train ])
+    metrics['train'], _ = timed(classifier.train)
+    metrics['save'], _ = timed(classifier.save)
+
+    classifier = timbl.TimblClassifier(fileprefix, options, format=format)
+    metrics['load'], _ = timed(classifier.load)
+
+    latencies = []
+    for features, _ in repeated(test, queries):
+        seconds, _ = timed(classifier.classify, features)
+        latencies.append(seconds * 1e6)
+    metrics['classify_latency_mean'] = sum(latencies) / len(latencies)
+    metrics['classify_latency_p50'] = percentile(latencies, 0.5)
+    metrics['classify_latency_p95'] = percentile(latencies, 0.95)
+    metrics['classify_latency_p99'] = percentile(latencies, 0.99)
+
+    testfile = fileprefix + ".test"
+    with io.open(testfile, 'w', encoding='utf-8') as f:
+        for features, cls in test:
+            f.write(classifier.formatinstance(features, cls) + "\n")
+    metrics['test'], metrics['accuracy'] = timed(classifier.test, testfile)
+    metrics['readtestoutput'], _ = timed(lambda: list(classifier.readtestoutput()))
+
+    if threads > 1:
+        threaded = timbl.TimblClassifier(fileprefix, options, format=format, threading=True)
+        threaded.load()
+        testinstances = [ features for features, _ in repeated(test, queries) ]
+        def work(i):
+            for features in testinstances[i::threads]:
+                threaded.classify(features)
+        workers = [ Thread(target=work, args=(i,)) for i in range(threads) ]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        metrics['threaded_throughput'] = len(testinstances) / (time.perf_counter() - start)
+
+    metrics['peak_rss_kb'] = peakrss()
+    return metrics
+
+
+def _child(connection, args):
+    try:
+        connection.send( (True, runconfiguration(*args)) )
+    except Exception as e:
+        connection.send( (False, "%s: %s" % (type(e).__name__, e)) )
+    finally:
+        connection.close()
+
+
+def run(datasets, formats, algorithms, queries=1000, threads=4, seed=0, workdir=None):
+    """Runs the benchmarks, each configuration in its own process, and returns the results as a dictionary"""
+    context = multiprocessing.get_context('fork')
+    tmpdir = tempfile.mkdtemp(prefix="timbl-benchmark-", dir=workdir)
+    results = []
+    try:
+        for dataset in datasets:
+            for format in formats:
+                for algorithm in algorithms:
+                    print("Benchmarking %s %s %s..." % (dataset, format, algorithm), file=sys.stderr)
+                    receiver, sender = context.Pipe(duplex=False)
+                    process = context.Process(target=_child, args=(sender, (tmpdir, dataset, format, algorithm, queries, threads, seed)))
+                    process.start()
+                    sender.close()
+                    try:
+                        ok, outcome = receiver.recv()
+                    except EOFError:
+                        ok, outcome = False, "benchmark process died with exit code %s" % process.exitcode
+                    process.join()
+                    result = { 'dataset': dataset, 'format': format, 'algorithm': algorithm }
+                    if ok:
+                        result['metrics'] = outcome
+                    else:
+                        print("Failed: " + outcome, file=sys.stderr)
+                        result['error'] = outcome
+                    results.append(result)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return {
+        'meta': {
+            'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'queries': queries,
+            'threads': threads,
+            'seed': seed,
+            'datasets': dict( (dataset, DATASETS[dataset]) for dataset in datasets ),
+            'algorithms': dict( (algorithm, ALGORITHMS[algorithm]) for algorithm in algorithms ),
+        },
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold=0.1):
+    """Compares two sets of results, returns a list of (key, metric, baseline value, current value, relative change, regression) tuples. The relative change is positive when performance got worse; a regression is a change beyond the threshold, e.g. (run with python -m doctest benchmark.py):
+
+    >>> results = lambda throughput: {'results': [{'dataset': 'small', 'format': 'Tabbed', 'algorithm': 'IB1', 'metrics': {'threaded_throughput': throughput}}]}
+    >>> compare(results(1000), results(500))
+    [(('small', 'Tabbed', 'IB1'), 'threaded_throughput', 1000, 500, 0.5, True)]
+    >>> compare(results(1000), results(2000))[0][-1]
+    False
+    """
+    def index(results):
+        return dict( ((result['dataset'], result['format'], result['algorithm']), result.get('metrics')) for result in results['results'] )
+    baselineresults = index(baseline)
+    comparison = []
+    for key, metrics in sorted(index(current).items()):
+        if not metrics or not baselineresults.get(key):
+            continue
+        for metric, value in sorted(metrics.items()):
+            before = baselineresults[key].get(metric)
+            if before is None:
+                continue
+            if before == 0:
+                change = 0.0 if value == 0 else float('inf')
+            else:
+                change = (value - before) / before
+            if metric in HIGHERISBETTER:
+                change = -change
+            comparison.append( (key, metric, before, value, change, change > threshold) )
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for python-timbl", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    runparser = subparsers.add_parser('run', help="Run the benchmarks", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    runparser.add_argument('--datasets', help="Comma separated datasets: " + ", ".join( "%s (%d instances, %d features, cardinality %d, %d classes)" % ((name,) + DATASETS[name]) for name in DATASETS ), default="small,medium,wide")
+    runparser.add_argument('--formats', help="Comma separated input formats", default=",".join(FORMATS))
+    runparser.add_argument('--algorithms', help="Comma separated algorithms: " + ", ".join(ALGORITHMS), default=",".join(ALGORITHMS))
+    runparser.add_argument('--queries', type=int, help="Number of single classifications to measure latency and threaded throughput over", default=1000)
+    runparser.add_argument('--threads', type=int, help="Number of threads for the throughput measurement (1 to skip it)", default=4)
+    runparser.add_argument('--seed', type=int, help="Random seed for the generated data", default=0)
+    runparser.add_argument('--workdir', help="Directory for temporary files", default=None)
+    runparser.add_argument('-o', '--output', help="Output JSON file (default: standard output)", default=None)
+    compareparser = subparsers.add_parser('compare', help="Compare two result files, exits with status 1 if there are regressions", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    compareparser.add_argument('baseline', help="JSON results to compare against")
+    compareparser.add_argument('current', help="JSON results to compare")
+    compareparser.add_argument('--threshold', type=float, help="Relative change considered a regression", default=0.1)
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        def parselist(value, valid):
+            items = [ item.strip() for item in value.split(",") if item.strip() ]
+            for item in items:
+                if item not in valid:
+                    parser.error("Unknown value: " + item)
+            return items
+        results = run(parselist(args.datasets, DATASETS), parselist(args.formats, FORMATS), parselist(args.algorithms, ALGORITHMS), args.queries, args.threads, args.seed, args.workdir)
+        if args.output:
+            with io.open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2)
+        else:
+            json.dump(results, sys.stdout, indent=2)
+            print()
+        return 1 if any( 'error' in result for result in results['results'] ) else 0
+    elif args.command == 'compare':
+        with io.open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        with io.open(args.current, 'r', encoding='utf-8') as f:
+            current = json.load(f)
+        regressions = 0
+        for key, metric, before, value, change, regression in compare(baseline, current, args.threshold):
+            print("%-30s %-24s %14.6g %14.6g %+8.1f%%%s" % ("/".join(key), metric, before, value, change * 100, "  REGRESSION" if regression else ""))
+            regressions += regression
+        print("%d regression(s)" % regressions, file=sys.stderr)
+        return 1 if regressions else 0
+    else:
+        parser.print_help()
+        return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -54,8 +54,13 @@
 
 #include <iostream>
 #include <sstream>
+#include <fstream>
+#include <cstdio>
 #include <string>
 #include <unordered_map>
+#include <map>
+#include <algorithm>
+#include <chrono>
 
 #ifndef __clang__
 #include <ext/stdio_filebuf.h>
@@ -63,14 +68,135 @@
 
 #include <boost/utility.hpp>
 #include <boost/python.hpp>
+#include <boost/python/stl_iterator.hpp>
 
 using namespace boost::python;
 
 
+bool TimblApiWrapper::learn(const std::string& filename)
+{
+    //release the GIL, the training file may be fed by another Python thread (see TimblClassifier.train_from)
+    NoGILSection section(this, true);
+    const unsigned long long nogilstart = starttimer();
+    bool result = Learn(filename);
+    stoptimer(instrumentation.nogiltime, nogilstart);
+    return result;
+}
+
+
+bool TimblApiWrapper::test(const std::string& testfile, const std::string& outfile, const std::string& percfile)
+{
+    //testing uses the experiment itself, like classifying without threading
+    NoGILSection section(this, true);
+    const unsigned long long nogilstart = starttimer();
+    bool result = Test(testfile, outfile, percfile);
+    stoptimer(instrumentation.nogiltime, nogilstart);
+    return result;
+}
+
+
+bool TimblApiWrapper::getInstanceBase(const std::string& filename)
+{
+    NoGILSection section(this, true);
+    const unsigned long long nogilstart = starttimer();
+    bool result = GetInstanceBase(filename);
+    stoptimer(instrumentation.nogiltime, nogilstart);
+    return result;
+}
+
+
+bool TimblApiWrapper::writeInstanceBase(const std::string& filename)
+{
+    NoGILSection section(this, false);
+    const unsigned long long nogilstart = starttimer();
+    bool result = WriteInstanceBase(filename);
+    stoptimer(instrumentation.nogiltime, nogilstart);
+    return result;
+}
+
+
+bool TimblApiWrapper::getWeights(const std::string& filename, Timbl::Weighting weighting)
+{
+    NoGILSection section(this, true);
+    const unsigned long long nogilstart = starttimer();
+    bool result = GetWeights(filename, weighting);
+    stoptimer(instrumentation.nogiltime, nogilstart);
+    return result;
+}
+
+
+bool TimblApiWrapper::saveWeights(const std::string& filename)
+{
+    NoGILSection section(this, false);
+    const unsigned long long nogilstart = starttimer();
+    bool result = SaveWeights(filename);
+    stoptimer(instrumentation.nogiltime, nogilstart);
+    return result;
+}
+
+
+bool TimblApiWrapper::update(const std::string& line, bool increment)
+{
+    //like updateMany(), for a single instance
+    NoGILSection section(this, true);
+    const unsigned long long nogilstart = starttimer();
+    bool result;
+    if (detachedexp != NULL) {
+        const auto line_unicode = TiCC::toUnicodeString(line);
+        result = increment ? detachedexp->Increment(line_unicode) : detachedexp->Decrement(line_unicode);
+    } else {
+        result = increment ? Increment(line) : Decrement(line);
+    }
+    stoptimer(instrumentation.nogiltime, nogilstart);
+    return result;
+}
+
+
+bool TimblApiWrapper::expand(const std::string& filename)
+{
+    NoGILSection section(this, true);
+    const unsigned long long nogilstart = starttimer();
+    bool result = (detachedexp != NULL) ? detachedexp->Expand(filename) : Expand(filename);
+    stoptimer(instrumentation.nogiltime, nogilstart);
+    return result;
+}
+
+
+bool TimblApiWrapper::remove(const std::string& filename)
+{
+    NoGILSection section(this, true);
+    const unsigned long long nogilstart = starttimer();
+    bool result = (detachedexp != NULL) ? detachedexp->Remove(filename) : Remove(filename);
+    stoptimer(instrumentation.nogiltime, nogilstart);
+    return result;
+}
+
+
+static python::dict distributiondict(const std::vector<std::pair<std::string,double> >& distribution)
+{
+    python::dict result;
+    for (std::vector<std::pair<std::string,double> >::const_iterator it = distribution.begin(); it != distribution.end(); it++) {
+        result[it->first] = it->second;
+    }
+    return result;
+}
+
+
 tuple TimblApiWrapper::classify(const std::string& line)
 {
 	std::string cls;
-	bool result = Classify(line, cls);
+	bool result;
+	//release the GIL before waiting for the lease, learn() may hold the model lock without the GIL while another thread feeds it
+	PyThreadState * m_thread_state = PyEval_SaveThread();
+	const unsigned long long nogilstart = starttimer();
+	{
+		ExperimentLease lease(this);
+		result = Classify(line, cls);
+	}
+	if (nogilstart != 0) instrumentation.nogilsections++;
+	stoptimer(instrumentation.nogiltime, nogilstart);
+	PyEval_RestoreThread(m_thread_state);
+	m_thread_state = NULL;
 	return boost::python::make_tuple(result, cls);
 }
 
@@ -79,93 +205,617 @@ tuple TimblApiWrapper::classify2(const std::string& line)
 {
 	std::string cls;
 	double distance;
-	bool result = Classify(line, cls, distance);
+	bool result;
+	PyThreadState * m_thread_state = PyEval_SaveThread(); //release GIL, see classify()
+	const unsigned long long nogilstart = starttimer();
+	{
+		ExperimentLease lease(this);
+		result = Classify(line, cls, distance);
+	}
+	if (nogilstart != 0) instrumentation.nogilsections++;
+	stoptimer(instrumentation.nogiltime, nogilstart);
+	PyEval_RestoreThread(m_thread_state);
+	m_thread_state = NULL;
 	return boost::python::make_tuple(result, cls, distance);
 }
 
 
 tuple TimblApiWrapper::classify3(const std::string& line, bool normalize, const unsigned char requireddepth)
 {
-	std::string cls;
-	double distance;
-    const Timbl::ClassDistribution * distrib;
-    const Timbl::TargetValue * result  = Classify(line, distrib , distance);
-    if (result != NULL) {
-        if ((requireddepth > 0) && (matchDepth() < requireddepth)) {
-            return boost::python::make_tuple(true, "", python::dict(), 999999);
-        } else {
-            const std::string cls = result->Name();
-            return boost::python::make_tuple(true, cls, dist2dict(distrib, normalize), distance);
+    ClassifyResult result;
+    PyThreadState * m_thread_state = PyEval_SaveThread(); //release GIL, see classify()
+    const unsigned long long nogilstart = starttimer();
+    {
+        //classifies with the experiment itself, the distribution is copied out before we wait for the GIL again
+        ExperimentLease lease(this);
+        classifyinto(NULL, line, normalize, requireddepth, result);
+    }
+    if (nogilstart != 0) instrumentation.nogilsections++;
+    stoptimer(instrumentation.nogiltime, nogilstart);
+    PyEval_RestoreThread(m_thread_state);
+    m_thread_state = NULL;
+
+    const unsigned long long convertstart = starttimer();
+    const python::dict distribution = distributiondict(result.distribution);
+    stoptimer(instrumentation.converttime, convertstart);
+    return boost::python::make_tuple(result.success, result.cls, distribution, result.distance);
+}
+
+
+static std::atomic<unsigned long long> nextpoolid(1);
+
+//The clone a thread used last, so it can get the same clone back without taking the pool lock
+struct ThreadAffinity {
+    unsigned long long poolid;
+    PooledExperiment * clone;
+};
+static thread_local ThreadAffinity affinity = {0, NULL};
+
+
+Timbl::TimblExperiment * TimblApiWrapper::cloneexperiment() {
+    Timbl::TimblExperiment * clonedexp = detachedexp->clone();
+    if (clonedexp == NULL) {
+        std::cerr << "(FATAL ERROR clonedexp=NULL)" << std::endl;
+        return NULL;
+    }
+    *clonedexp = *detachedexp; //ugly but needed
+    if ( detachedexp->getOptParams() ){
+        clonedexp->setOptParams( detachedexp->getOptParams()->Clone(0) );
+    }
+    if (debug) std::cerr << "(Created experiment clone " << (size_t) clonedexp << ", runningthreads=" << runningthreads << ")" << std::endl;
+    return clonedexp;
+}
+
+PooledExperiment * TimblApiWrapper::checkout() {
+    //must be called without holding the GIL, it may wait for a clone to become available
+    runningthreads++;
+    checkouts++;
+    if ((affinity.poolid == poolid) && (affinity.clone != NULL)) {
+        bool expected = false;
+        if (affinity.clone->inuse.compare_exchange_strong(expected, true)) {
+            fastcheckouts++;
+            return affinity.clone;
+        }
+    }
+
+    PooledExperiment * clone = NULL;
+    bool create = false;
+    {
+        std::unique_lock<std::mutex> guard(poollock);
+        waiting++; //announced before scanning, so a concurrent checkin() can not be missed
+        while (clone == NULL) {
+            for (std::vector<PooledExperiment *>::iterator iter = clones.begin(); iter != clones.end(); iter++) {
+                bool expected = false;
+                if ((*iter)->inuse.compare_exchange_strong(expected, true)) {
+                    clone = *iter;
+                    break;
+                }
+            }
+            if ((clone == NULL) && ((maxclones == 0) || (clones.size() < maxclones))) {
+                clone = new PooledExperiment(); //checked out from the start, filled in below
+                clones.push_back(clone);
+                create = true;
+            } else if (clone == NULL) {
+                waits++;
+                poolcond.wait(guard);
+            }
+        }
+        waiting--;
+    }
+    if (create) {
+        clone->exp = cloneexperiment();
+        if (debug) std::cerr << "(Experiment pool size = " << clones.size() << ")" << std::endl;
+    }
+    affinity.poolid = poolid;
+    affinity.clone = clone;
+    return clone;
+}
+
+void TimblApiWrapper::checkin(PooledExperiment * clone) {
+    clone->inuse.store(false);
+    runningthreads--;
+    if (waiting > 0) {
+        std::lock_guard<std::mutex> guard(poollock);
+        poolcond.notify_one();
+    }
+}
+
+void TimblApiWrapper::prepareClones(size_t count) {
+    //create the clones ahead of the first classifications, by checking them all out at once
+    if ((maxclones > 0) && (count > maxclones)) count = maxclones;
+    PyThreadState * m_thread_state = PyEval_SaveThread();
+    std::vector<PooledExperiment *> prepared;
+    for (size_t i = 0; i < count; i++) {
+        prepared.push_back(checkout());
+    }
+    for (std::vector<PooledExperiment *>::iterator iter = prepared.begin(); iter != prepared.end(); iter++) {
+        checkin(*iter);
+    }
+    PyEval_RestoreThread(m_thread_state);
+}
+
+python::dict TimblApiWrapper::poolStats() {
+    python::dict stats;
+    size_t inuse = 0;
+    size_t size;
+    {
+        std::lock_guard<std::mutex> guard(poollock);
+        size = clones.size();
+        for (std::vector<PooledExperiment *>::const_iterator iter = clones.begin(); iter != clones.end(); iter++) {
+            if ((*iter)->inuse) inuse++;
+        }
+    }
+    stats["clones"] = size;
+    stats["inuse"] = inuse;
+    stats["maxclones"] = maxclones;
+    stats["checkouts"] = (size_t) checkouts;
+    stats["fastcheckouts"] = (size_t) fastcheckouts;
+    stats["waits"] = (size_t) waits;
+    stats["runningthreads"] = (int) runningthreads;
+    return stats;
+}
+
+void Instrumentation::reset() {
+    classifications = failures = 0;
+    classifytime = converttime = nogiltime = nogilsections = 0;
+    for (size_t i = 0; i < LATENCYBUCKETS; i++) latency[i] = 0;
+}
+
+unsigned long long TimblApiWrapper::starttimer() const {
+    if (!instrumentation.enabled) return 0;
+    return std::chrono::duration_cast<std::chrono::nanoseconds>(std::chrono::steady_clock::now().time_since_epoch()).count();
+}
+
+void TimblApiWrapper::stoptimer(std::atomic<unsigned long long>& counter, unsigned long long start) {
+    if (start == 0) return; //instrumentation was disabled when the timer started
+    counter += starttimer() - start;
+}
+
+void TimblApiWrapper::recordclassification(unsigned long long start, bool success) {
+    //may be called without the GIL, everything here is atomic
+    if (start == 0) return;
+    const unsigned long long elapsed = starttimer() - start;
+    instrumentation.classifytime += elapsed;
+    instrumentation.classifications++;
+    if (!success) instrumentation.failures++;
+    const unsigned long long microseconds = elapsed / 1000;
+    size_t bucket = 0;
+    while ((bucket < LATENCYBUCKETS - 1) && (microseconds >> bucket)) bucket++;
+    instrumentation.latency[bucket]++;
+}
+
+python::dict TimblApiWrapper::stats() {
+    python::dict stats;
+    stats["enabled"] = (bool) instrumentation.enabled;
+    stats["classifications"] = (unsigned long long) instrumentation.classifications;
+    stats["failures"] = (unsigned long long) instrumentation.failures;
+    python::dict time;
+    time["classify"] = instrumentation.classifytime / 1e9;
+    time["convert"] = instrumentation.converttime / 1e9;
+    time["nogil"] = instrumentation.nogiltime / 1e9;
+    stats["time"] = time;
+    stats["nogilsections"] = (unsigned long long) instrumentation.nogilsections;
+    python::list latency;
+    for (size_t i = 0; i < LATENCYBUCKETS; i++) latency.append((unsigned long long) instrumentation.latency[i]);
+    stats["latency"] = latency;
+    stats["pool"] = threaded() ? python::object(poolStats()) : python::object();
+    return stats;
+}
+
+tuple TimblApiWrapper::classify3safe(const std::string& line, bool normalize,const unsigned char requireddepth)
+{
+    ClassifyResult result;
+    PyThreadState * m_thread_state = PyEval_SaveThread(); //release GIL
+    const unsigned long long nogilstart = starttimer();
+    {
+        //the distribution is copied out of the clone, so it can go back to the pool before we wait for the GIL again
+        ExperimentLease lease(this);
+        classifyinto(lease.get(), line, normalize, requireddepth, result);
+    }
+    if (nogilstart != 0) instrumentation.nogilsections++;
+    stoptimer(instrumentation.nogiltime, nogilstart);
+    PyEval_RestoreThread(m_thread_state);
+    m_thread_state = NULL;
+
+    const unsigned long long convertstart = starttimer();
+    const python::dict distribution = distributiondict(result.distribution);
+    stoptimer(instrumentation.converttime, convertstart);
+    return boost::python::make_tuple(result.success, result.cls, distribution, result.distance);
+}
+
+static void copydistribution(const Timbl::ClassDistribution * distrib, bool normalize, std::vector<std::pair<std::string,double> >& out)
+{
+    //called without the GIL, so no Python objects may be touched here
+    double sum = 0.0;
+    if (normalize) {
+        for (Timbl::ClassDistribution::VDlist::const_iterator it = distrib->begin(); it != distrib->end(); it++) {
+            sum += it->second->Weight();
         }
+    }
+    out.reserve(distrib->size());
+    for (Timbl::ClassDistribution::VDlist::const_iterator it = distrib->begin(); it != distrib->end(); it++) {
+        const double weight = (normalize && sum > 0) ? it->second->Weight() / sum : it->second->Weight();
+        out.push_back(std::pair<std::string,double>(it->second->Value()->Name(), weight));
+    }
+}
+
+void TimblApiWrapper::classifyinto(Timbl::TimblExperiment * exp, const std::string& line, bool normalize, const unsigned char requireddepth, ClassifyResult& out)
+{
+    //called without the GIL, so no Python objects may be touched here
+    const Timbl::ClassDistribution * distrib;
+    double distance;
+    const Timbl::TargetValue * result;
+    size_t depth;
+    const unsigned long long start = starttimer();
+    if (exp != NULL) {
+        result = exp->Classify(TiCC::toUnicodeString(line), distrib, distance);
+        depth = (result != NULL) ? exp->matchDepth() : 0;
     } else {
-        return boost::python::make_tuple(false,"",python::dict(),999999);
+        result = Classify(line, distrib, distance);
+        depth = (result != NULL) ? matchDepth() : 0;
+    }
+    recordclassification(start, result != NULL);
+    out.distribution.clear();
+    if (result == NULL) {
+        out.success = false;
+        out.cls = "";
+        out.distance = 999999;
+    } else if ((requireddepth > 0) && (depth < requireddepth)) {
+        out.success = true;
+        out.cls = "";
+        out.distance = 999999;
+    } else {
+        out.success = true;
+        out.cls = result->Name();
+        out.distance = distance;
+        const unsigned long long convertstart = starttimer();
+        copydistribution(distrib, normalize, out.distribution);
+        stoptimer(instrumentation.converttime, convertstart);
     }
 }
 
+python::list TimblApiWrapper::classifyMany(python::object lines, bool normalize, const unsigned char requireddepth)
+{
+    //copy the input while we still hold the GIL
+    std::vector<std::string> instances;
+    for (python::stl_input_iterator<std::string> iter(lines), end; iter != end; ++iter) {
+        instances.push_back(*iter);
+    }
+    std::vector<ClassifyResult> results(instances.size());
 
-Timbl::TimblExperiment * TimblApiWrapper::getexperimentforthread() {
-    pthread_t thisthread = pthread_self();
-    Timbl::TimblExperiment * clonedexp = NULL;
-    pthread_mutex_lock(&lock);
-    for (std::vector<std::pair<pthread_t,Timbl::TimblExperiment *> >::const_iterator iter = experimentpool.begin(); iter != experimentpool.end(); iter++) {
-        if (iter->first == thisthread) {
-            if (debug) std::cerr << "(Experiment in pool for thread " << (size_t) thisthread << ", runningthreads=" << runningthreads << ")" << std::endl;
-            clonedexp = iter->second;
-            break;
+    //classify the whole batch natively with the GIL released once
+    PyThreadState * m_thread_state = PyEval_SaveThread();
+    const unsigned long long nogilstart = starttimer();
+    {
+        ExperimentLease lease(this);
+        for (size_t i = 0; i < instances.size(); i++) {
+            classifyinto(lease.get(), instances[i], normalize, requireddepth, results[i]);
         }
     }
-    pthread_mutex_unlock(&lock);
+    if (nogilstart != 0) instrumentation.nogilsections++;
+    stoptimer(instrumentation.nogiltime, nogilstart);
+    PyEval_RestoreThread(m_thread_state);
+    m_thread_state = NULL;
 
-    if (clonedexp == NULL) {
-        clonedexp = detachedexp->clone();
-        if (debug) std::cerr << "(Creating new experiment in pool for thread " << (size_t) thisthread << ", clonedexp=" << (size_t) clonedexp << ", experimentpool=" << (size_t) &experimentpool << ", runningthreads=" << runningthreads << ")" << std::endl;
-        *clonedexp = *detachedexp; //ugly but needed
-        if ( detachedexp->getOptParams() ){
-            clonedexp->setOptParams( detachedexp->getOptParams()->Clone(0) );
+    const unsigned long long convertstart = starttimer();
+    python::list output;
+    for (std::vector<ClassifyResult>::const_iterator iter = results.begin(); iter != results.end(); iter++) {
+        output.append(boost::python::make_tuple(iter->success, iter->cls, distributiondict(iter->distribution), iter->distance));
+    }
+    stoptimer(instrumentation.converttime, convertstart);
+    return output;
+}
+
+python::list TimblApiWrapper::updateMany(python::object lines, bool increment)
+{
+    std::vector<std::string> instances;
+    for (python::stl_input_iterator<std::string> iter(lines), end; iter != end; ++iter) {
+        instances.push_back(*iter);
+    }
+    std::vector<size_t> failed;
+
+    PyThreadState * m_thread_state = PyEval_SaveThread();
+    const unsigned long long nogilstart = starttimer();
+    {
+        //the clones share the instance base with the detached experiment, so wait for running classifications to finish
+        std::unique_lock<std::shared_mutex> writing(modellock);
+        for (size_t i = 0; i < instances.size(); i++) {
+            bool result;
+            if (detachedexp != NULL) {
+                const auto line_unicode = TiCC::toUnicodeString(instances[i]);
+                result = increment ? detachedexp->Increment(line_unicode) : detachedexp->Decrement(line_unicode);
+            } else {
+                result = increment ? Increment(instances[i]) : Decrement(instances[i]);
+            }
+            if (!result) failed.push_back(i);
         }
-        if (clonedexp == NULL) {
-            std::cerr << "(FATAL ERROR clonedexp=NULL)" << std::endl;
+    }
+    stoptimer(instrumentation.nogiltime, nogilstart);
+    PyEval_RestoreThread(m_thread_state);
+
+    python::list output;
+    for (std::vector<size_t>::const_iterator iter = failed.begin(); iter != failed.end(); iter++) {
+        output.append(*iter);
+    }
+    return output;
+}
+
+bool TimblApiWrapper::snapshot(const std::string& ibasefile, const std::string& weightsfile)
+{
+    bool result = true;
+    PyThreadState * m_thread_state = PyEval_SaveThread();
+    {
+        //classification may go on meanwhile, changes to the instance base have to wait
+        std::shared_lock<std::shared_mutex> reading(modellock);
+        if (detachedexp != NULL) {
+            if (!ibasefile.empty()) result = detachedexp->WriteInstanceBase(ibasefile);
+            if (result && !weightsfile.empty()) result = detachedexp->SaveWeights(weightsfile);
         } else {
-            pthread_mutex_lock(&lock);
-            experimentpool.push_back(std::pair<pthread_t,Timbl::TimblExperiment*>(thisthread,clonedexp));
-            pthread_mutex_unlock(&lock);
+            if (!ibasefile.empty()) result = WriteInstanceBase(ibasefile);
+            if (result && !weightsfile.empty()) result = SaveWeights(weightsfile);
         }
-        if (debug) std::cerr << "(Experimentpool size = " << experimentpool.size() << ")" << std::endl;
     }
-    return clonedexp;
+    PyEval_RestoreThread(m_thread_state);
+    return result;
 }
 
-tuple TimblApiWrapper::classify3safe(const std::string& line, bool normalize,const unsigned char requireddepth)
+python::dict TimblApiWrapper::memoryInfo()
 {
-    runningthreads++;
-    PyThreadState * m_thread_state = PyEval_SaveThread(); //release GIL
+    std::ostringstream buf;
+    bool result;
+    PyThreadState * m_thread_state = PyEval_SaveThread();
+    {
+        std::shared_lock<std::shared_mutex> reading(modellock);
+        result = (detachedexp != NULL) ? detachedexp->ShowIBInfo(buf) : ShowIBInfo(buf);
+    }
+    PyEval_RestoreThread(m_thread_state);
+
+    python::dict info;
+    if (!result) return info;
+    //TiMBL only reports this as text: "Size of InstanceBase = <n> Nodes, (<n> bytes), <x> % compression"
+    const std::string text = buf.str();
+    const size_t pos = text.find("Size of InstanceBase");
+    unsigned long nodes, bytes;
+    double compression;
+    if ((pos != std::string::npos) && (sscanf(text.c_str() + pos, "Size of InstanceBase = %lu Nodes, (%lu bytes), %lf", &nodes, &bytes, &compression) == 3)) {
+        info["nodes"] = nodes;
+        info["bytes"] = bytes;
+        info["compression"] = compression;
+    }
+    info["text"] = text;
+    return info;
+}
+
+python::dict TimblApiWrapper::evaluate(const std::string& testfile, const std::string& outfile, const std::string& delimiter, bool normalize, bool distributions)
+{
+    std::vector<std::string> gold, predicted;
+    std::vector<double> distances;
+    std::vector<std::vector<std::pair<std::string,double> > > distribs;
+    std::map<std::pair<std::string,std::string>, size_t> confusion;
+    size_t failures = 0;
+    bool opened;
+
+    PyThreadState * m_thread_state = PyEval_SaveThread();
+    const unsigned long long nogilstart = starttimer();
+    {
+        ExperimentLease lease(this);
+        Timbl::TimblExperiment * exp = lease.get();
+        std::ifstream in(testfile.c_str());
+        std::ofstream out;
+        if (!outfile.empty()) out.open(outfile.c_str());
+        opened = in.good() && (outfile.empty() || out.good());
+        std::string line;
+        ClassifyResult result;
+        while (opened && std::getline(in, line)) {
+            const size_t last = line.find_last_not_of(" \t\r");
+            if (last == std::string::npos) continue; //empty line
+            line.erase(last + 1);
+            const size_t split = line.find_last_of(delimiter);
+            const std::string goldlabel = (split == std::string::npos) ? line : line.substr(split + 1);
+
+            classifyinto(exp, line, normalize, 0, result);
+            if (!result.success) failures++;
+            gold.push_back(goldlabel);
+            predicted.push_back(result.cls);
+            distances.push_back(result.distance);
+            confusion[std::make_pair(goldlabel, result.cls)]++;
+            if (distributions) distribs.push_back(result.distribution);
+            if (!outfile.empty()) {
+                out << line << ' ' << result.cls << " {";
+                for (size_t i = 0; i < result.distribution.size(); i++) {
+                    out << ((i > 0) ? ", " : " ") << result.distribution[i].first << ' ' << result.distribution[i].second;
+                }
+                out << " } " << result.distance << '\n';
+            }
+        }
+    }
+    if (nogilstart != 0) instrumentation.nogilsections++;
+    stoptimer(instrumentation.nogiltime, nogilstart);
+    PyEval_RestoreThread(m_thread_state);
+
+    if (!opened) {
+        PyErr_SetString(PyExc_IOError, ("Unable to open " + testfile + (outfile.empty() ? "" : " or " + outfile)).c_str());
+        python::throw_error_already_set();
+    }
+
+    //per-class precision, recall and F1, and overall accuracy, all from the confusion matrix
+    std::map<std::string, size_t> truepositives, goldcounts, predictedcounts;
+    size_t correct = 0;
+    python::dict confusiondict;
+    for (std::map<std::pair<std::string,std::string>, size_t>::const_iterator iter = confusion.begin(); iter != confusion.end(); iter++) {
+        confusiondict[python::make_tuple(iter->first.first, iter->first.second)] = iter->second;
+        goldcounts[iter->first.first] += iter->second;
+        predictedcounts[iter->first.second] += iter->second;
+        if (iter->first.first == iter->first.second) {
+            truepositives[iter->first.first] += iter->second;
+            correct += iter->second;
+        }
+    }
+    python::dict classes;
+    for (std::map<std::string, size_t>::const_iterator iter = goldcounts.begin(); iter != goldcounts.end(); iter++) {
+        const double tp = truepositives[iter->first];
+        const double precision = (predictedcounts[iter->first] > 0) ? tp / predictedcounts[iter->first] : 0.0;
+        const double recall = tp / iter->second;
+        const double f1 = (precision + recall > 0) ? 2 * precision * recall / (precision + recall) : 0.0;
+        classes[iter->first] = python::make_tuple(precision, recall, f1, iter->second);
+    }
+
+    python::list goldlist, predictedlist, distancelist, distributionlist;
+    for (size_t i = 0; i < gold.size(); i++) {
+        goldlist.append(gold[i]);
+        predictedlist.append(predicted[i]);
+        distancelist.append(distances[i]);
+        if (distributions) {
+            python::dict distribution;
+            for (std::vector<std::pair<std::string,double> >::const_iterator it = distribs[i].begin(); it != distribs[i].end(); it++) {
+                distribution[it->first] = it->second;
+            }
+            distributionlist.append(distribution);
+        }
+    }
+
+    python::dict output;
+    output["gold"] = goldlist;
+    output["predicted"] = predictedlist;
+    output["distance"] = distancelist;
+    output["distribution"] = distributions ? python::object(distributionlist) : python::object();
+    output["accuracy"] = gold.empty() ? 0.0 : (double) correct / gold.size();
+    output["failures"] = failures;
+    output["confusion"] = confusiondict;
+    output["classes"] = classes;
+    return output;
+}
 
-    Timbl::TimblExperiment * clonedexp = getexperimentforthread();
+typedef std::pair<double, const Timbl::TargetValue *> WeightedClass;
 
+static bool heavier(const WeightedClass& a, const WeightedClass& b) {
+    return a.first > b.first;
+}
+
+python::tuple TimblApiWrapper::classifyIndexed(const std::string& line, bool normalize, size_t topk)
+{
+    std::vector<WeightedClass> weights;
+    const Timbl::TargetValue * result;
     const Timbl::ClassDistribution * distrib;
     double distance;
-    const auto line_unicode = TiCC::toUnicodeString(line);
-    const Timbl::TargetValue * result = clonedexp->Classify(line_unicode, distrib,distance);
-    if (result != NULL) {
-        if ((requireddepth > 0) && (clonedexp->matchDepth() < requireddepth)) {
-            PyEval_RestoreThread(m_thread_state);
-            m_thread_state = NULL;
-            runningthreads--;
-            return boost::python::make_tuple(true, "", python::dict(), 999999);
+
+    PyThreadState * m_thread_state = PyEval_SaveThread();
+    const unsigned long long nogilstart = starttimer();
+    {
+        //everything needed from the distribution is copied before the lease ends
+        ExperimentLease lease(this);
+        const unsigned long long start = starttimer();
+        if (lease.get() != NULL) {
+            result = lease.get()->Classify(TiCC::toUnicodeString(line), distrib, distance);
         } else {
-            const std::string cls = result->Name();
-            //const std::string diststring = distrib->DistToString();
-            PyEval_RestoreThread(m_thread_state);
-            m_thread_state = NULL;
-            runningthreads--;
-            return boost::python::make_tuple(true, cls, dist2dict(distrib, normalize), distance);
+            result = Classify(line, distrib, distance);
         }
-    } else {
-        PyEval_RestoreThread(m_thread_state);
-        m_thread_state = NULL;
-        runningthreads--;
-        return boost::python::make_tuple(false,"",python::dict(),999999);
+        recordclassification(start, result != NULL);
+        if (result != NULL) {
+            double sum = 0.0;
+            weights.reserve(distrib->size());
+            for (Timbl::ClassDistribution::VDlist::const_iterator it = distrib->begin(); it != distrib->end(); it++) {
+                weights.push_back(WeightedClass(it->second->Weight(), it->second->Value()));
+                sum += it->second->Weight();
+            }
+            if (normalize && sum > 0) {
+                for (std::vector<WeightedClass>::iterator it = weights.begin(); it != weights.end(); it++) it->first /= sum;
+            }
+            const size_t k = ((topk > 0) && (topk < weights.size())) ? topk : weights.size();
+            std::partial_sort(weights.begin(), weights.begin() + k, weights.end(), heavier);
+            weights.resize(k);
+        }
+    }
+    if (nogilstart != 0) instrumentation.nogilsections++;
+    stoptimer(instrumentation.nogiltime, nogilstart);
+    PyEval_RestoreThread(m_thread_state);
+
+    if (result == NULL) {
+        return boost::python::make_tuple(false, -1, python::object(), python::object(), 0.0, 999999);
     }
+
+    //the target values live as long as the model, their names are added to the vocabulary now we hold the GIL again
+    weights.push_back(WeightedClass(0.0, result));
+    std::vector<int> indices(weights.size());
+    std::vector<double> values(weights.size());
+    for (size_t i = 0; i < weights.size(); i++) {
+        const size_t index = weights[i].second->Index();
+        if (index >= classvocabulary.size()) classvocabulary.resize(index + 1);
+        if (classvocabulary[index].empty()) classvocabulary[index] = weights[i].second->Name();
+        indices[i] = index;
+        values[i] = weights[i].first;
+    }
+    weights.pop_back();
+    indices.pop_back();
+    values.pop_back();
+
+    const double margin = (weights.size() > 1) ? weights[0].first - weights[1].first : ((weights.size() == 1) ? weights[0].first : 0.0);
+    python::object indexbytes(python::handle<>(PyBytes_FromStringAndSize((const char *) indices.data(), indices.size() * sizeof(int))));
+    python::object weightbytes(python::handle<>(PyBytes_FromStringAndSize((const char *) values.data(), values.size() * sizeof(double))));
+    return boost::python::make_tuple(true, (int) result->Index(), indexbytes, weightbytes, margin, distance);
+}
+
+python::list TimblApiWrapper::neighboursMany(python::object lines, bool normalize)
+{
+    std::vector<std::string> instances;
+    for (python::stl_input_iterator<std::string> iter(lines), end; iter != end; ++iter) {
+        instances.push_back(*iter);
+    }
+    std::vector<NeighbourResult> results(instances.size());
+
+    PyThreadState * m_thread_state = PyEval_SaveThread();
+    const unsigned long long nogilstart = starttimer();
+    {
+        ExperimentLease lease(this);
+        for (size_t i = 0; i < instances.size(); i++) {
+            //the neighbour set belongs to the experiment and is overwritten by the next classification, so copy it
+            const unsigned long long start = starttimer();
+            const Timbl::neighborSet * neighbours;
+            if (lease.get() != NULL) {
+                neighbours = lease.get()->NB_Classify(TiCC::toUnicodeString(instances[i]));
+            } else {
+                neighbours = classifyNS(instances[i]);
+            }
+            recordclassification(start, neighbours != NULL);
+            results[i].success = (neighbours != NULL);
+            if (neighbours == NULL) continue;
+            const unsigned long long convertstart = starttimer();
+            results[i].distances.resize(neighbours->size());
+            results[i].distributions.resize(neighbours->size());
+            for (size_t k = 0; k < neighbours->size(); k++) {
+                results[i].distances[k] = neighbours->getDistance(k);
+                copydistribution(neighbours->getDistribution(k), normalize, results[i].distributions[k]);
+            }
+            stoptimer(instrumentation.converttime, convertstart);
+        }
+    }
+    if (nogilstart != 0) instrumentation.nogilsections++;
+    stoptimer(instrumentation.nogiltime, nogilstart);
+    PyEval_RestoreThread(m_thread_state);
+
+    python::list output;
+    for (std::vector<NeighbourResult>::const_iterator iter = results.begin(); iter != results.end(); iter++) {
+        if (!iter->success) {
+            output.append(boost::python::make_tuple(false, python::object(), python::list()));
+            continue;
+        }
+        python::list distributions;
+        for (size_t k = 0; k < iter->distributions.size(); k++) {
+            distributions.append(distributiondict(iter->distributions[k]));
+        }
+        python::object distancebytes(python::handle<>(PyBytes_FromStringAndSize((const char *) iter->distances.data(), iter->distances.size() * sizeof(double))));
+        output.append(boost::python::make_tuple(true, distancebytes, distributions));
+    }
+    return output;
+}
+
+python::list TimblApiWrapper::classVocabulary()
+{
+    python::list result;
+    for (std::vector<std::string>::const_iterator it = classvocabulary.begin(); it != classvocabulary.end(); it++) {
+        result.append(*it);
+    }
+    return result;
 }
 
 std::string TimblApiWrapper::bestNeighbours()
@@ -220,9 +870,13 @@ std::string TimblApiWrapper::settings()
 }
 
 
-void TimblApiWrapper::initthreading() {
+void TimblApiWrapper::initthreading(size_t maxclones) {
+    //the experiment is disconnected, so nothing may classify with it meanwhile
+    NoGILSection section(this, true);
     initExperiment();
     detachedexp = grabAndDisconnectExp();
+    this->maxclones = maxclones;
+    poolid = nextpoolid++;
 }
 
 
@@ -240,29 +894,6 @@ bool TimblApiWrapper::showSettings(object& stream)
 }
 
 
-python::dict TimblApiWrapper::dist2dict(const Timbl::ClassDistribution * distribution, bool normalize, double minf) const {
-    python::dict result;
-
-    double freq;
-    double sum = 0.0;
-    if (normalize) {
-        for (Timbl::ClassDistribution::VDlist::const_iterator it = distribution->begin(); it != distribution->end(); it++) {
-            sum += it->second->Weight();
-        }
-    }
-    for (Timbl::ClassDistribution::VDlist::const_iterator it = distribution->begin(); it != distribution->end(); it++) {
-        if (normalize) {
-            it->second->SetWeight(it->second->Weight() / sum);
-        }
-        freq = it->second->Weight();
-        if ( freq >= minf ){
-            result[it->second->Value()->Name()] = freq;
-        }
-    }
-
-    return result;
-}
-
 /*std::string TimblApiWrapper::weights()
 {
 	std::ostringstream buf;
@@ -285,6 +916,153 @@ bool TimblApiWrapper::showWeights(object& stream)
 }*/
 
 
+//Read-only view on an object exposing the buffer protocol (e.g. a numpy array), used for bulk serialisation
+class BufferView : boost::noncopyable {
+    Py_buffer view;
+    char type;
+public:
+    BufferView(python::object obj, int ndim) {
+        if (PyObject_GetBuffer(obj.ptr(), &view, PyBUF_RECORDS_RO) != 0) python::throw_error_already_set();
+        const char * format = (view.format != NULL) ? view.format : "B";
+        while ((*format == '@') || (*format == '=') || (*format == '<') || (*format == '>') || (*format == '!')) format++;
+        type = *format;
+        if ((view.ndim != ndim) || (std::string("bBhHiIlLqQfd?").find(type) == std::string::npos) || (format[1] != '\0')) {
+            PyBuffer_Release(&view);
+            PyErr_SetString(PyExc_ValueError, "Expected a numeric array of the right dimensionality");
+            python::throw_error_already_set();
+        }
+    }
+    ~BufferView() { PyBuffer_Release(&view); }
+
+    Py_ssize_t shape(int dim) const { return view.shape[dim]; }
+    const char * at(Py_ssize_t i) const { return (const char *) view.buf + i * view.strides[0]; }
+    const char * at(Py_ssize_t i, Py_ssize_t j) const { return (const char *) view.buf + i * view.strides[0] + j * view.strides[1]; }
+
+    long long integer(const char * p) const {
+        switch (type) {
+            case 'b': return *(const signed char *) p;
+            case 'B': return *(const unsigned char *) p;
+            case '?': return *(const bool *) p;
+            case 'h': return *(const short *) p;
+            case 'H': return *(const unsigned short *) p;
+            case 'i': return *(const int *) p;
+            case 'I': return *(const unsigned int *) p;
+            case 'l': return *(const long *) p;
+            case 'L': return *(const unsigned long *) p;
+            case 'q': return *(const long long *) p;
+            case 'Q': return *(const unsigned long long *) p;
+            case 'f': return (long long) *(const float *) p;
+            default: return (long long) *(const double *) p;
+        }
+    }
+
+    void write(std::ostream& out, const char * p) const {
+        if (type == 'f') {
+            writefloat(out, *(const float *) p);
+        } else if (type == 'd') {
+            writefloat(out, *(const double *) p);
+        } else {
+            out << integer(p);
+        }
+    }
+
+    static void writefloat(std::ostream& out, double value) {
+        char buffer[32];
+        snprintf(buffer, sizeof(buffer), "%.15g", value);
+        out << buffer;
+    }
+};
+
+static void writedenserow(std::ostream& out, const BufferView& X, Py_ssize_t i, const std::string& delimiter) {
+    for (Py_ssize_t j = 0; j < X.shape(1); j++) {
+        X.write(out, X.at(i, j));
+        out << delimiter;
+    }
+}
+
+static void writesparserow(std::ostream& out, const BufferView& data, const BufferView& indices, const BufferView& indptr, Py_ssize_t i) {
+    const long long end = indptr.integer(indptr.at(i+1));
+    for (long long k = indptr.integer(indptr.at(i)); k < end; k++) {
+        out << '(' << indices.integer(indices.at(k)) + 1 << ',';
+        data.write(out, data.at(k));
+        out << ')';
+    }
+    out << ' ';
+}
+
+static std::vector<std::string> extractlabels(python::object labels, Py_ssize_t rows) {
+    std::vector<std::string> result;
+    result.reserve(rows);
+    for (python::stl_input_iterator<std::string> iter(labels), end; iter != end; ++iter) {
+        result.push_back(*iter);
+    }
+    if ((Py_ssize_t) result.size() != rows) {
+        PyErr_SetString(PyExc_ValueError, "Number of labels does not match number of rows");
+        python::throw_error_already_set();
+    }
+    return result;
+}
+
+bool writeDense(const std::string& filename, python::object matrix, python::object labels, const std::string& delimiter, bool append) {
+    BufferView X(matrix, 2);
+    const std::vector<std::string> classes = extractlabels(labels, X.shape(0));
+    PyThreadState * m_thread_state = PyEval_SaveThread();
+    std::ofstream out(filename.c_str(), append ? std::ios::app : std::ios::trunc);
+    for (Py_ssize_t i = 0; out.good() && (i < X.shape(0)); i++) {
+        writedenserow(out, X, i, delimiter);
+        out << classes[i] << '\n';
+    }
+    out.close();
+    const bool result = !out.fail();
+    PyEval_RestoreThread(m_thread_state);
+    return result;
+}
+
+bool writeSparse(const std::string& filename, python::object data, python::object indices, python::object indptr, python::object labels, bool append) {
+    BufferView d(data, 1), ind(indices, 1), ptr(indptr, 1);
+    const std::vector<std::string> classes = extractlabels(labels, ptr.shape(0) - 1);
+    PyThreadState * m_thread_state = PyEval_SaveThread();
+    std::ofstream out(filename.c_str(), append ? std::ios::app : std::ios::trunc);
+    for (Py_ssize_t i = 0; out.good() && (i < ptr.shape(0) - 1); i++) {
+        writesparserow(out, d, ind, ptr, i);
+        out << classes[i] << '\n';
+    }
+    out.close();
+    const bool result = !out.fail();
+    PyEval_RestoreThread(m_thread_state);
+    return result;
+}
+
+python::list formatDense(python::object matrix, const std::string& delimiter) {
+    BufferView X(matrix, 2);
+    python::list result;
+    std::ostringstream buf;
+    for (Py_ssize_t i = 0; i < X.shape(0); i++) {
+        buf.str("");
+        writedenserow(buf, X, i, delimiter);
+        buf << '?';
+        result.append(buf.str());
+    }
+    return result;
+}
+
+python::list formatSparse(python::object data, python::object indices, python::object indptr) {
+    BufferView d(data, 1), ind(indices, 1), ptr(indptr, 1);
+    python::list result;
+    std::ostringstream buf;
+    for (Py_ssize_t i = 0; i < ptr.shape(0) - 1; i++) {
+        buf.str("");
+        writesparserow(buf, d, ind, ptr, i);
+        buf << '?';
+        result.append(buf.str());
+    }
+    return result;
+}
+
+
+BOOST_PYTHON_MEMBER_FUNCTION_OVERLOADS(initthreading_overloads, TimblApiWrapper::initthreading, 0, 1)
+BOOST_PYTHON_MEMBER_FUNCTION_OVERLOADS(getweights_overloads, TimblApiWrapper::getWeights, 1, 2)
+
 BOOST_PYTHON_MODULE(timblapi)
 {
 	scope().attr("__doc__") = MODULE_DOC;
@@ -293,21 +1071,21 @@ BOOST_PYTHON_MODULE(timblapi)
 																							TIMBLAPI_DOC,
 																							init<const std::string&,
 																							const std::string&>(INIT_DOC))
-		.def("learn", &TimblApiWrapper::Learn, LEARN_DOC)
-		.def("test", &TimblApiWrapper::Test, TEST_DOC)
+		.def("learn", &TimblApiWrapper::learn, LEARN_DOC)
+		.def("test", &TimblApiWrapper::test, TEST_DOC)
 
 		.def("setOptions", &TimblApiWrapper::SetOptions, SETOPTIONS_DOC)
 		.def("showOptions", &TimblApiWrapper::showOptions, SHOWOPTIONS_DOC)
 		.def("showSettings", &TimblApiWrapper::showSettings, SHOWSETTINGS_DOC)
 		.def("showStatistics", &TimblApiWrapper::ShowStatistics, SHOWSTATISTICS_DOC)
 
-		.def("writeInstanceBase", &TimblApiWrapper::WriteInstanceBase,
+		.def("writeInstanceBase", &TimblApiWrapper::writeInstanceBase,
 				 WRITEINSTANCEBASE_DOC)
-		.def("getInstanceBase", &TimblApiWrapper::GetInstanceBase,
+		.def("getInstanceBase", &TimblApiWrapper::getInstanceBase,
 				 GETINSTANCEBASE_DOC)
 
-		.def("saveWeights", &TimblApiWrapper::SaveWeights, SAVEWEIGHTS_DOC)
-		.def("getWeights", &TimblApiWrapper::GetWeights, GETWEIGHTS_DOC)
+		.def("saveWeights", &TimblApiWrapper::saveWeights, SAVEWEIGHTS_DOC)
+		.def("getWeights", &TimblApiWrapper::getWeights, getweights_overloads(GETWEIGHTS_DOC))
 
 		.def("getAccuracy", &TimblApiWrapper::GetAccuracy, GETACCURACY_DOC)
 
@@ -318,8 +1096,17 @@ BOOST_PYTHON_MODULE(timblapi)
 		.def("classify2", &TimblApiWrapper::classify2, CLASSIFY2_DOC)
 		.def("classify3", &TimblApiWrapper::classify3, CLASSIFY3_DOC)
 		.def("classify3safe", &TimblApiWrapper::classify3safe, CLASSIFY3SAFE_DOC)
+		.def("classifyMany", &TimblApiWrapper::classifyMany, CLASSIFYMANY_DOC)
+		.def("evaluate", &TimblApiWrapper::evaluate, EVALUATE_DOC)
+		.def("classifyIndexed", &TimblApiWrapper::classifyIndexed, CLASSIFYINDEXED_DOC)
+		.def("classVocabulary", &TimblApiWrapper::classVocabulary, CLASSVOCABULARY_DOC)
 
-		.def("initthreading", &TimblApiWrapper::initthreading, INITTHREADING_DOC)
+		.def("initthreading", &TimblApiWrapper::initthreading, initthreading_overloads(INITTHREADING_DOC))
+		.def("prepareClones", &TimblApiWrapper::prepareClones, PREPARECLONES_DOC)
+		.def("poolStats", &TimblApiWrapper::poolStats, POOLSTATS_DOC)
+		.def("enableStats", &TimblApiWrapper::enableStats, ENABLESTATS_DOC)
+		.def("resetStats", &TimblApiWrapper::resetStats, RESETSTATS_DOC)
+		.def("stats", &TimblApiWrapper::stats, STATS_DOC)
 		.def("enableDebug", &TimblApiWrapper::enableDebug, ENABLEDEBUG_DOC)
 
 		.def("showBestNeighbours", &TimblApiWrapper::showBestNeighbours,
@@ -328,10 +1115,14 @@ BOOST_PYTHON_MODULE(timblapi)
 				 SHOWBESTNEIGHBORS_DOC)
 
 
-		.def("increment", &TimblApiWrapper::Increment, INCREMENT_DOC)
-		.def("decrement", &TimblApiWrapper::Decrement, DECREMENT_DOC)
-		.def("expand", &TimblApiWrapper::Expand, EXPAND_DOC)
-		.def("remove", &TimblApiWrapper::Remove, REMOVE_DOC)
+		.def("increment", &TimblApiWrapper::increment, INCREMENT_DOC)
+		.def("decrement", &TimblApiWrapper::decrement, DECREMENT_DOC)
+		.def("expand", &TimblApiWrapper::expand, EXPAND_DOC)
+		.def("remove", &TimblApiWrapper::remove, REMOVE_DOC)
+		.def("incrementMany", &TimblApiWrapper::incrementMany, INCREMENTMANY_DOC)
+		.def("decrementMany", &TimblApiWrapper::decrementMany, DECREMENTMANY_DOC)
+		.def("snapshot", &TimblApiWrapper::snapshot, SNAPSHOT_DOC)
+		.def("memoryInfo", &TimblApiWrapper::memoryInfo, MEMORYINFO_DOC)
 
 		.def("writeNamesFile", &TimblApiWrapper::WriteNamesFile,
 				 WRITENAMESFILE_DOC)
@@ -345,6 +1136,7 @@ BOOST_PYTHON_MODULE(timblapi)
 		//.def("showWeights", &TimblApiWrapper::showWeights)
 
 		// EXTRA METHODS
+		.def("neighboursMany", &TimblApiWrapper::neighboursMany, NEIGHBOURSMANY_DOC)
 		.def("bestNeighbours", &TimblApiWrapper::bestNeighbours,
 				 BESTNEIGHBOURS_DOC)
 		.def("bestNeighbors", &TimblApiWrapper::bestNeighbours,
@@ -375,6 +1167,11 @@ BOOST_PYTHON_MODULE(timblapi)
 		.value("SV", Timbl::SV)
 	;
 
+	def("writeDense", writeDense, WRITEDENSE_DOC);
+	def("writeSparse", writeSparse, WRITESPARSE_DOC);
+	def("formatDense", formatDense, FORMATDENSE_DOC);
+	def("formatSparse", formatSparse, FORMATSPARSE_DOC);
+
 	//def("to_string", to_string);
 }
 
@@ -51,50 +51,139 @@
 #include <timbl/TimblAPI.h>
 
 #include <boost/python.hpp>
+#include <boost/noncopyable.hpp>
 #include <iostream>
 #include <string>
 #include <vector>
 #include <utility>
-#include <pthread.h>
+#include <atomic>
+#include <mutex>
+#include <shared_mutex>
+#include <condition_variable>
 
 namespace python = boost::python;
 
+struct ClassifyResult {
+    bool success;
+    std::string cls;
+    std::vector<std::pair<std::string,double> > distribution;
+    double distance;
+};
+
+
+//The neighbour set of one instance, copied out of the experiment: the distance and class distribution at each k
+struct NeighbourResult {
+    bool success;
+    std::vector<double> distances;
+    std::vector<std::vector<std::pair<std::string,double> > > distributions;
+};
+
+
+//A clone of the experiment in the pool used for thread-safe classification
+struct PooledExperiment {
+    Timbl::TimblExperiment * exp;
+    std::atomic<bool> inuse;
+    PooledExperiment() : exp(NULL), inuse(true) {}
+};
+
+
+#define LATENCYBUCKETS 32
+
+//Counters for the opt-in instrumentation (see enableStats()), times are in nanoseconds
+struct Instrumentation {
+    std::atomic<bool> enabled;
+    std::atomic<unsigned long long> classifications, failures;
+    std::atomic<unsigned long long> classifytime, converttime, nogiltime, nogilsections;
+    std::atomic<unsigned long long> latency[LATENCYBUCKETS]; //bucket i counts native classifications that took less than 2^i microseconds
+    Instrumentation() : enabled(false) { reset(); }
+    void reset();
+};
+
 
 class TimblApiWrapper : public Timbl::TimblAPI {
 private:
-    std::vector<std::pair<pthread_t,Timbl::TimblExperiment *> > experimentpool;
     Timbl::TimblExperiment * detachedexp;
-    python::dict dist2dict(const Timbl::ClassDistribution * dist,  bool=true,double=0) const;
-    pthread_mutex_t lock; //global lock
+    std::vector<PooledExperiment *> clones; //only grows, clones are reused and deleted with the wrapper
+    size_t maxclones; //0 = unbounded
+    unsigned long long poolid; //identifies this pool in the thread-local fast path
+    std::mutex poollock; //guards clones, only taken when the fast path fails
+    std::condition_variable poolcond;
+    std::atomic<int> waiting;
+    std::atomic<size_t> checkouts, fastcheckouts, waits;
+    std::shared_mutex modellock; //held shared while clones classify, exclusively while classifying without threading or changing the instance base; never wait for the GIL while holding it
+    friend class ExperimentLease;
+    friend class NoGILSection;
+    void classifyinto(Timbl::TimblExperiment * exp, const std::string& line, bool normalize, const unsigned char requireddepth, ClassifyResult& out);
+    Timbl::TimblExperiment * cloneexperiment();
     bool debug;
-    int runningthreads;
+    std::atomic<int> runningthreads;
+    std::vector<std::string> classvocabulary; //class names by TiMBL's class index, only modified while holding the GIL
+    Instrumentation instrumentation;
+    unsigned long long starttimer() const; //0 if instrumentation is disabled
+    void stoptimer(std::atomic<unsigned long long>& counter, unsigned long long start);
+    void recordclassification(unsigned long long start, bool success);
 public:
 	TimblApiWrapper(const std::string& args, const std::string& name="") : Timbl::TimblAPI(args, name) {
         detachedexp = NULL;
         debug = false;
         runningthreads = 0;
-        pthread_mutex_init(&lock, NULL);
+        maxclones = 0;
+        poolid = 0;
+        waiting = 0;
+        checkouts = fastcheckouts = waits = 0;
     }
     ~TimblApiWrapper() {
         if (debug) std::cerr << "TimblApiWrapper Destructor" << std::endl;
         if (runningthreads == 0) {
             if (detachedexp != NULL) delete detachedexp;
-            for (std::vector<std::pair<pthread_t,Timbl::TimblExperiment *> >::iterator iter = experimentpool.begin(); iter != experimentpool.end(); iter++) {
-                delete iter->second;
+            for (std::vector<PooledExperiment *>::iterator iter = clones.begin(); iter != clones.end(); iter++) {
+                delete (*iter)->exp;
+                delete *iter;
             }
+        } else {
+            std::cerr << "(TimblApiWrapper destroyed while " << runningthreads << " threads are classifying, not freeing experiments)" << std::endl;
         }
     }
 
 
 
-    void initthreading();
+    void initthreading(size_t maxclones=0);
     void enableDebug() { debug = true; };
-    Timbl::TimblExperiment * getexperimentforthread();
+    bool threaded() const { return detachedexp != NULL; };
+    PooledExperiment * checkout();
+    void checkin(PooledExperiment * clone);
+    void prepareClones(size_t count);
+    python::dict poolStats();
+    python::list updateMany(python::object lines, bool increment);
+    python::list incrementMany(python::object lines) { return updateMany(lines, true); };
+    python::list decrementMany(python::object lines) { return updateMany(lines, false); };
+    bool snapshot(const std::string& ibasefile, const std::string& weightsfile);
+    python::dict memoryInfo();
+    void enableStats(bool enabled) { instrumentation.enabled = enabled; };
+    void resetStats() { instrumentation.reset(); };
+    python::dict stats();
+
+	bool learn(const std::string& filename);
+	bool test(const std::string& testfile, const std::string& outfile, const std::string& percfile);
+	bool getInstanceBase(const std::string& filename);
+	bool writeInstanceBase(const std::string& filename);
+	bool getWeights(const std::string& filename, Timbl::Weighting weighting=Timbl::UNKNOWN_W);
+	bool saveWeights(const std::string& filename);
+	bool update(const std::string& line, bool increment);
+	bool increment(const std::string& line) { return update(line, true); };
+	bool decrement(const std::string& line) { return update(line, false); };
+	bool expand(const std::string& filename);
+	bool remove(const std::string& filename);
 
 	python::tuple classify(const std::string& line);
 	python::tuple classify2(const std::string& line);
 	python::tuple classify3(const std::string& line, bool normalize=true,const unsigned char requireddepth=0);
 	python::tuple classify3safe(const std::string& line, bool normalize=true,const unsigned char requireddepth=0);
+	python::list classifyMany(python::object lines, bool normalize=true,const unsigned char requireddepth=0);
+	python::tuple classifyIndexed(const std::string& line, bool normalize=true, size_t topk=0);
+	python::list classVocabulary();
+	python::list neighboursMany(python::object lines, bool normalize=true);
+	python::dict evaluate(const std::string& testfile, const std::string& outfile, const std::string& delimiter, bool normalize=true, bool distributions=false);
 
 	std::string bestNeighbours();
 	bool showBestNeighbours(python::object& stream);
@@ -110,4 +199,48 @@ public:
 
 };
 
+
+//Checks out a clone of the experiment for the duration of its scope if threading is enabled (get() returns NULL otherwise),
+//and keeps the instance base from changing meanwhile. Without threading, it gives exclusive use of the one experiment.
+class ExperimentLease : boost::noncopyable {
+    TimblApiWrapper * wrapper;
+    std::shared_lock<std::shared_mutex> reading;
+    std::unique_lock<std::shared_mutex> exclusive;
+    PooledExperiment * clone;
+public:
+    ExperimentLease(TimblApiWrapper * wrapper) : wrapper(wrapper), clone(NULL) {
+        if (wrapper->threaded()) {
+            reading = std::shared_lock<std::shared_mutex>(wrapper->modellock);
+            clone = wrapper->checkout();
+        } else {
+            exclusive = std::unique_lock<std::shared_mutex>(wrapper->modellock);
+        }
+    }
+    ~ExperimentLease() { if (clone != NULL) wrapper->checkin(clone); }
+    Timbl::TimblExperiment * get() const { return (clone != NULL) ? clone->exp : NULL; }
+};
+
+
+//Releases the GIL for the duration of its scope, for long-running calls that do not touch Python objects, and holds the
+//model lock meanwhile: shared if the call only reads the instance base, exclusively if it uses the experiment itself or
+//changes the instance base. The lock is taken after releasing the GIL and given up before taking the GIL back.
+class NoGILSection : boost::noncopyable {
+    PyThreadState * threadstate;
+    std::shared_lock<std::shared_mutex> reading;
+    std::unique_lock<std::shared_mutex> exclusive;
+public:
+    NoGILSection(TimblApiWrapper * wrapper, bool exclusively) : threadstate(PyEval_SaveThread()) {
+        if (exclusively) {
+            exclusive = std::unique_lock<std::shared_mutex>(wrapper->modellock);
+        } else {
+            reading = std::shared_lock<std::shared_mutex>(wrapper->modellock);
+        }
+    }
+    ~NoGILSection() {
+        if (exclusive.owns_lock()) exclusive.unlock();
+        if (reading.owns_lock()) reading.unlock();
+        PyEval_RestoreThread(threadstate);
+    }
+};
+
 #endif
@@ -13,10 +13,29 @@ from __future__ import division
 from __future__ import absolute_import
 
 import sys
+import tempfile
 from tempfile import mktemp
 import timblapi
 import io
 import os
+from threading import Thread, Event, Lock
+import itertools
+import collections
+from array import array
+import multiprocessing
+import asyncio
+import socket
+import struct
+import json
+import argparse
+import zlib
+import time
+import random
+import math
+import queue
+import heapq
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 
 stderr = sys.stderr
 stdout = sys.stdout
@@ -37,8 +56,321 @@ def u(s, encoding = 'utf-8', errors='strict'):
         return str(s,encoding,errors=errors)
 
 
+def _inmemoryfile(callback, data=None):
+    """Calls callback with the path of an anonymous in-memory file, initialised with data if given, and returns the final contents of the file. Falls back to a temporary file on platforms without memfd_create(). Mostly for internal use"""
+    if hasattr(os, 'memfd_create'):
+        fd = os.memfd_create('timbl')
+        path = '/proc/self/fd/' + str(fd)
+    else:
+        fd, path = tempfile.mkstemp()
+    try:
+        if data:
+            with io.open(path, 'wb') as f:
+                f.write(data)
+        if not callback(path):
+            raise LoadException("TiMBL failed to read or write " + path)
+        with io.open(path, 'rb') as f:
+            return f.read()
+    finally:
+        os.close(fd)
+        if not hasattr(os, 'memfd_create'):
+            os.unlink(path)
+
+
+_shardclassifier = None #classifier shared with forked workers by _shard()
+
+def _classifyshard(args):
+    #runs in a forked worker, the instance base is shared copy-on-write with the parent
+    lines, requireddepth = args
+    return _shardclassifier.api.classifyMany(lines, _shardclassifier.normalize, requireddepth)
+
+
+def _crossvalidatefold(args):
+    #runs in a worker process: trains on all folds but one and tests on that one
+    options, foldfiles, fold, delimiter, normalize = args
+    trainfile = foldfiles[fold] + ".train"
+    with io.open(trainfile, 'wb') as f:
+        for i, foldfile in enumerate(foldfiles):
+            if i != fold:
+                with io.open(foldfile, 'rb') as part:
+                    f.write(part.read())
+    try:
+        api = timblapi.TimblAPI(options, "")
+        if not api.learn(trainfile):
+            raise LoadException("TiMBL failed to learn fold " + str(fold))
+        result = api.evaluate(foldfiles[fold], '', delimiter, normalize, False)
+    finally:
+        os.unlink(trainfile)
+    return { 'fold': fold, 'size': len(result['gold']), 'accuracy': result['accuracy'], 'failures': result['failures'], 'confusion': result['confusion'], 'classes': result['classes'] }
+
+
+_leaveoneoutapi = None #leave-one-out experiment shared with forked workers by leaveoneout_parallel()
+
+def _leaveoneoutchunk(args):
+    #runs in a forked worker, each instance in the chunk is left out of the shared instance base in turn
+    chunkfile, outfile, size = args
+    if not _leaveoneoutapi.test(chunkfile, outfile, ''):
+        raise LoadException("TiMBL failed to test " + chunkfile)
+    return size, _leaveoneoutapi.getAccuracy()
+
+
+#options that can be changed on a learned experiment with setOptions(), all others need relearning
+RUNTIMEOPTIONS = ('-k', '-m', '-d', '-w', '-L', '-v', '+v')
+
+_searchexperiment = None #learned experiment and settings shared with forked workers by search()
+
+def _searchconfiguration(options):
+    #runs in a worker forked for this configuration alone, so options set here do not carry over to the next one
+    api, baseoptions, trainfile, testfile, delimiter, normalize = _searchexperiment
+    start = time.perf_counter()
+    runtime = all( option[:2] in RUNTIMEOPTIONS for option in _splitoptions(options) )
+    relearned = not (runtime and api.setOptions(options))
+    if relearned:
+        api = timblapi.TimblAPI(baseoptions + " " + options, "")
+        if not api.learn(trainfile):
+            raise LoadException("TiMBL failed to learn with options " + options)
+    learned = time.perf_counter()
+    result = api.evaluate(testfile, '', delimiter, normalize, False)
+    end = time.perf_counter()
+    return { 'options': options, 'accuracy': result['accuracy'], 'failures': result['failures'], 'relearned': relearned, 'learntime': learned - start, 'testtime': end - learned }
+
+
+def _splitoptions(options):
+    """Splits an option string into a list of options with their values, e.g. '-k 3 +vdb -m M' into ['-k 3', '+vdb', '-m M']"""
+    result = []
+    for token in options.split():
+        if token[0] in '-+' or not result:
+            result.append(token)
+        else:
+            result[-1] += " " + token
+    return result
+
+
+def _classmetrics(confusion):
+    """Computes (precision, recall, F1, support) for each class from a confusion matrix, given as a dictionary mapping (gold, predicted) to counts"""
+    truepositives = collections.Counter()
+    goldcounts = collections.Counter()
+    predictedcounts = collections.Counter()
+    for (gold, predicted), count in confusion.items():
+        goldcounts[gold] += count
+        predictedcounts[predicted] += count
+        if gold == predicted:
+            truepositives[gold] += count
+    classes = {}
+    for cls, support in goldcounts.items():
+        precision = truepositives[cls] / predictedcounts[cls] if predictedcounts[cls] else 0.0
+        recall = truepositives[cls] / support
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        classes[cls] = (precision, recall, f1, support)
+    return classes
+
+
+class FeatureSchema(object):
+    """Declares the type of each feature once, so instances can be encoded without checking every feature. Types are int, float or str (symbolic), or their names. Numeric features are only converted to strings. Symbolic values are checked for the delimiter once, when first seen, and are then looked up in a vocabulary per feature. With compact, symbolic values are passed to TiMBL as short integer codes rather than as themselves, values not seen in training are all encoded as UNKNOWN. Values are trusted to be of the declared type"""
+
+    UNKNOWN = "-1"
+
+    def __init__(self, types, compact=False):
+        self.types = []
+        for t in types:
+            if t in (int, 'int'):
+                self.types.append('int')
+            elif t in (float, 'float'):
+                self.types.append('float')
+            elif t in (str, 'str', 'symbolic'):
+                self.types.append('str')
+            else:
+                raise ValueError("Unsupported feature type: " + repr(t))
+        self.width = len(self.types)
+        self.compact = compact
+        self.delimiter = None #set by the classifier
+        self.lock = Lock()
+        self.vocabularies = [ {} if t == 'str' else None for t in self.types ]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = Lock()
+
+    def _intern(self, vocabulary, value, learn):
+        """Checks a symbolic value that is not in the vocabulary yet and returns its code, adding it to the vocabulary if learn is set. Mostly for internal use"""
+        text = value if isinstance(value, str) else str(value)
+        if self.delimiter and self.delimiter in text:
+            raise ValueError("Feature contains delimiter: " + text)
+        if not learn:
+            return self.UNKNOWN if self.compact else text
+        with self.lock:
+            code = vocabulary.get(value)
+            if code is None:
+                code = sys.intern(str(len(vocabulary)) if self.compact else text)
+                vocabulary[value] = code
+        return code
+
+    def _checkwidth(self, features):
+        if len(features) != self.width:
+            raise ValueError("Expected " + str(self.width) + " features, got " + str(len(features)))
+
+    def encode(self, features, learn=False):
+        """Encodes one instance, returns a list of strings. Symbolic values are added to the vocabulary if learn is set"""
+        self._checkwidth(features)
+        encoded = []
+        for value, vocabulary in zip(features, self.vocabularies):
+            if vocabulary is None:
+                encoded.append(str(value))
+            else:
+                code = vocabulary.get(value)
+                encoded.append(code if code is not None else self._intern(vocabulary, value, learn))
+        return encoded
+
+    def encodebatch(self, rows, learn=False):
+        """Encodes a batch of instances (an iterable of sequences, or a two-dimensional array) column by column, returns a list of lines with the features joined by the delimiter"""
+        rows = rows.tolist() if hasattr(rows, 'tolist') else list(rows) #read twice, so a generator is not used up
+        for row in rows:
+            self._checkwidth(row)
+        if not rows:
+            return []
+        columns = []
+        for column, vocabulary in zip(zip(*rows), self.vocabularies):
+            if vocabulary is None:
+                columns.append(map(str, column))
+            else:
+                codes = list(map(vocabulary.get, column))
+                if None in codes:
+                    codes = [ code if code is not None else self._intern(vocabulary, value, learn) for code, value in zip(codes, column) ]
+                columns.append(codes)
+        return list(map(self.delimiter.join, zip(*columns)))
+
+    def decode(self, codes):
+        """Maps encoded features, e.g. from readtestoutput(), back to their values. Only makes a difference with compact"""
+        if not self.compact:
+            return list(codes)
+        if getattr(self, 'inverse', None) is None or any( len(inverse) != len(vocabulary) for inverse, vocabulary in zip(self.inverse, self.vocabularies) if vocabulary is not None ):
+            self.inverse = [ dict( (code, value) for value, code in vocabulary.items() ) if vocabulary is not None else None for vocabulary in self.vocabularies ]
+        return [ inverse.get(code, code) if inverse is not None else code for code, inverse in zip(codes, self.inverse) ]
+
+    def save(self, filename):
+        """Writes the types and vocabularies to a JSON file"""
+        with io.open(filename, 'w', encoding='utf-8') as f:
+            json.dump({ 'types': self.types, 'compact': self.compact, 'vocabularies': [ list(vocabulary.items()) if vocabulary is not None else None for vocabulary in self.vocabularies ] }, f)
+
+    def read(self, filename):
+        """Reads the vocabularies written by save(), which must be for the same types"""
+        with io.open(filename, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data['types'] != self.types or data['compact'] != self.compact:
+            raise ValueError("Feature schema in " + filename + " does not match")
+        with self.lock:
+            self.vocabularies = [ dict( (value, sys.intern(code)) for value, code in vocabulary ) if vocabulary is not None else None for vocabulary in data['vocabularies'] ]
+            self.inverse = None
+
+
+class BackgroundWriter(object):
+    """Writes batches of lines to a file in a background thread, so the caller can prepare the next batch in the meantime. At most maxbatches batches are queued; beyond that write() blocks until the thread catches up. An error in the background thread is raised in the caller by the next write(), flush() or close(); nothing is written after the error, and unwritten() returns the lines that were not written. The writer is closed at interpreter exit if it has not been closed before, so queued lines are not lost"""
+
+    def __init__(self, filename, mode='w', encoding='utf-8', maxbatches=2):
+        self.filename = filename
+        self.file = io.open(filename, mode, encoding=encoding)
+        self.queue = queue.Queue(maxbatches)
+        self.error = None
+        self.pending = collections.deque() #batches handed to write() that are not written yet, in order
+        self.written = 0 #number of lines written
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            try:
+                if batch is None:
+                    return
+                if self.error is None:
+                    #encoded as a whole, so a batch that can not be encoded is not written at all
+                    self.file.write("".join( line + "\n" for line in batch ))
+                    self.file.flush()
+                    self.pending.popleft()
+                    self.written += len(batch)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raiseerror(self):
+        if self.error is not None:
+            raise IOError("Unable to write to " + self.filename + ": " + str(self.error))
+
+    def write(self, lines):
+        """Queues a batch (list) of lines to be written, without line endings. The list must not be changed afterwards"""
+        self._raiseerror()
+        self.pending.append(lines)
+        self.queue.put(lines)
+
+    def unwritten(self):
+        """Returns the lines handed to write() that have not been written (yet), e.g. because of an error"""
+        return [ line for batch in self.pending for line in batch ]
+
+    def flush(self):
+        """Waits until all queued lines are written and flushed to the file"""
+        self.queue.join()
+        self._raiseerror()
+
+    def close(self):
+        """Writes all queued lines, stops the thread and closes the file"""
+        atexit.unregister(self.close)
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.file.close()
+        self._raiseerror()
+
+
+class TestFileWriter(object):
+    """Writes instances to a file in the input format of a classifier, e.g. to build a test file, through a background writer rather than opening and closing the file for every instance as TimblClassifier.addinstance() does. Use as a context manager, the file is complete once the context is left::
+
+        with TestFileWriter(classifier, "testfile") as writer:
+            writer.addinstance( (1,0,0), 'financial')
+    """
+
+    def __init__(self, classifier, testfile, append=True, bufferlines=1000):
+        self.classifier = classifier
+        self.bufferlines = bufferlines
+        self.buffer = []
+        self.writer = BackgroundWriter(testfile, 'a' if append else 'w', classifier.encoding)
+
+    def addinstance(self, features, classlabel="?"):
+        """Adds an instance to the file"""
+        self.buffer.append(self.classifier.formatinstance(features, classlabel))
+        if len(self.buffer) >= self.bufferlines:
+            self.flush(False)
+
+    def flush(self, wait=True):
+        """Hands the buffered instances to the background writer, and unless wait is False waits until they are written"""
+        if self.buffer:
+            self.writer.write(self.buffer)
+            self.buffer = []
+        if wait:
+            self.writer.flush()
+
+    def close(self):
+        if self.buffer:
+            self.writer.write(self.buffer)
+            self.buffer = []
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 class TimblClassifier(object):
-    def __init__(self, fileprefix, timbloptions, format = "Tabbed", dist=True, encoding = 'utf-8', overwrite = True,  flushthreshold=10000, threading=False, normalize=True, debug=False, sklearn=False, flushdir=None):
+    def __init__(self, fileprefix, timbloptions, format = "Tabbed", dist=True, encoding = 'utf-8', overwrite = True,  flushthreshold=10000, threading=False, normalize=True, debug=False, sklearn=False, flushdir=None, threads=1, cachesize=0, picklecompression=0, maxclones=0, schema=None, instrument=False, statscallback=None, statsinterval=1000, snapshotinterval=0, aggregate=False):
         if format.lower() == "tabbed":
             self.format = "Tabbed"
             self.delimiter = "\t"
@@ -59,8 +391,21 @@ class TimblClassifier(object):
 
         self.normalize= normalize
 
+        self.schema = schema
+        if schema is not None:
+            if self.format == "Sparse":
+                raise ValueError("A feature schema can not be used with the Sparse format")
+            if schema.delimiter is not None and schema.delimiter != self.delimiter:
+                raise ValueError("Feature schema is already in use with another delimiter")
+            schema.delimiter = self.delimiter
+
         self.flushthreshold = flushthreshold
         self.instances = []
+        self.aggregate = aggregate
+        self.counts = collections.Counter() #aggregated instances in memory, if aggregate is set
+        self.runs = [] #sorted files with aggregated instances spilled from memory, merged into the training file on flush
+        self.aggregated = False #whether the training file has been written with counts, by a merge
+        self.writer = None #background writer for the training file, started on the first flush
         self.api = None
         self.debug = debug
         self.sklearn = sklearn
@@ -75,15 +420,38 @@ class TimblClassifier(object):
             else:
                 self.flushed = 1
 
-        self.threading = threading
+        self.threads = threads
+        self.maxclones = maxclones
+        self.pool = None
+
+        self.cachesize = cachesize
+        self.cache = collections.OrderedDict()
+        self.cachelock = Lock()
+        self.cachehits = self.cachemisses = self.cacheevictions = 0
+        self.cachegeneration = 0 #bumped by clearcache(), so results computed before a model change are not cached after it
 
-    def validatefeatures(self,features):
+        self.picklecompression = picklecompression
+        self.threading = threading or threads > 1
+
+        self.instrument = instrument
+        self.statscallback = statscallback
+        self.statsinterval = statsinterval
+        self.statslock = Lock()
+        self.resetstats()
+
+        self.snapshotinterval = snapshotinterval
+        self.updates = 0 #instances learned or forgotten since the last snapshot
+        self.instancecount = None #instances in the loaded instance base, counted by memory() when first needed
+
+    def validatefeatures(self,features, learn=False):
         """Returns features in validated form, or raises an Exception. Mostly for internal use"""
+        if self.schema is not None:
+            return self.schema.encode(features, learn)
         validatedfeatures = []
         for feature in features:
             if isinstance(feature, int) or isinstance(feature, float):
                 validatedfeatures.append( str(feature) )
-            elif self.delimiter in feature and not self.sklearn:
+            elif self.delimiter and self.delimiter in feature and not self.sklearn:
                 raise ValueError("Feature contains delimiter: " + feature)
             elif self.sklearn and isinstance(feature, str): #then is sparse added together
                 validatedfeatures.append(feature)
@@ -91,39 +459,162 @@ class TimblClassifier(object):
                 validatedfeatures.append(feature)
         return validatedfeatures
 
-    def append(self, features, classlabel):
+    def formatinstance(self, features, classlabel, learn=False):
+        """Returns the instance as a line in the input format, or raises an Exception. Set learn for training instances, so new values are added to the vocabulary of a feature schema; test instances leave it unchanged. Mostly for internal use"""
         if not isinstance(features, list) and not isinstance(features, tuple):
             raise ValueError("Expected list or tuple of features")
 
-        features = self.validatefeatures(features)
+        features = self.validatefeatures(features, learn)
 
         if self.delimiter in classlabel and self.delimiter != '':
             raise ValueError("Class label contains delimiter: " + self.delimiter)
 
-        self.instances.append(self.delimiter.join(features) + (self.delimiter if not self.delimiter == '' else ' ') + classlabel)
+        return self.delimiter.join(features) + (self.delimiter if not self.delimiter == '' else ' ') + classlabel
+
+    def append(self, features, classlabel):
+        if self.aggregate:
+            self.counts[self.formatinstance(features, classlabel, True)] += 1
+            if len(self.counts) >= self.flushthreshold:
+                self._spill()
+                if len(self.runs) >= 64: #bound the number of files open while merging
+                    self._mergeruns()
+            return
+        self.instances.append(self.formatinstance(features, classlabel, True))
         if len(self.instances) >= self.flushthreshold:
-            self.flush()
+            self.flush(wait=False)
 
-    def flush(self):
-        if self.debug: print("Flushing...",file=sys.stderr)
-        if len(self.instances) == 0: return False
+    def _weightoption(self):
+        """Returns the TiMBL option for the exemplar weights in the training file, if it is written with aggregate set. Mostly for internal use"""
+        return " -s" if self.aggregate else ""
 
-        if hasattr(self, 'flushfile'):
-            f = io.open(self.flushfile,'w', encoding=self.encoding)
-        else:
-            if self.flushed:
-                f = io.open(self.fileprefix + ".train",'a', encoding=self.encoding)
+    def _addweight(self, instance, weight=1):
+        """Returns the instance as a line of the training file, with its weight if aggregate is set. Mostly for internal use"""
+        if not self.aggregate:
+            return instance
+        return instance + (self.delimiter or ' ') + str(weight)
+
+    def _stripweight(self, line):
+        """Splits a line of the training file into the instance and its weight, which is 1 unless aggregate is set. Mostly for internal use"""
+        if not self.aggregate:
+            return line, 1
+        instance, weight = line.rsplit(self.delimiter or ' ', 1)
+        return instance, int(weight)
+
+    def _fieldcount(self, line):
+        """Returns the number of fields after the features in a line, or all of them except in the Sparse format. Mostly for internal use"""
+        if self.format == "Sparse":
+            return len(line.rsplit(")", 1)[-1].split())
+        return len(line.split(self.delimiter))
+
+    def _spill(self):
+        """Writes the aggregated instances in memory to a sorted run file, which flush() merges into the training file. Mostly for internal use"""
+        fd, runfile = tempfile.mkstemp(prefix=os.path.basename(self.fileprefix) + ".run.", dir=os.path.dirname(os.path.abspath(self.fileprefix)))
+        try:
+            with io.open(fd, 'w', encoding=self.encoding) as f:
+                for instance in sorted(self.counts):
+                    f.write(self._addweight(instance, self.counts[instance]) + "\n")
+        except IOError:
+            os.unlink(runfile)
+            raise
+        self.runs.append(runfile)
+        self.counts = collections.Counter()
+
+    def _mergeruns(self):
+        """Merges the aggregated instances into the training file, which holds every unique instance once, in sorted order, followed by its count as exemplar weight. Mostly for internal use"""
+        if not self.counts and not self.runs:
+            return False
+        filename = self.flushfile if hasattr(self, 'flushfile') else self.fileprefix + ".train"
+        if self.flushed and not self.aggregated and os.path.exists(filename):
+            #a training file that was there before, see whether it already has counts
+            if self.counts:
+                reference = next(iter(self.counts))
             else:
-                f = io.open(self.fileprefix + ".train",'w', encoding=self.encoding)
+                with io.open(self.runs[0], 'r', encoding=self.encoding) as f:
+                    reference = self._stripweight(f.readline().rstrip("\n"))[0]
+            with io.open(filename, 'r', encoding=self.encoding) as f:
+                first = next(( line.rstrip("\n") for line in f if line.strip() ), None)
+                if first is not None and self._fieldcount(first) == self._fieldcount(reference):
+                    #plain instances, count them like appended ones
+                    f.seek(0)
+                    for line in f:
+                        line = line.rstrip("\n")
+                        if line.strip():
+                            self.counts[line] += 1
+                            if len(self.counts) >= self.flushthreshold:
+                                self._spill()
+                    self.flushed = 0
+                elif first is not None and self._fieldcount(first) != self._fieldcount(reference) + 1:
+                    raise ValueError("Training file " + filename + " does not match the appended instances")
+            self.aggregated = True
+        if self.counts:
+            self._spill()
+        #a training file with counts, written earlier, is itself a sorted run
+        runs = self.runs + [ filename ] if self.flushed and os.path.exists(filename) else self.runs
 
-        for instance in self.instances:
-            f.write(instance +  "\n")
+        def readrun(runfile):
+            with io.open(runfile, 'r', encoding=self.encoding) as f:
+                for line in f:
+                    line = line.rstrip("\n")
+                    if line:
+                        yield self._stripweight(line)
 
-        self.flushed += len(self.instances)
-        f.close()
-        self.instances = []
+        unique = 0
+        with io.open(filename + ".tmp", 'w', encoding=self.encoding) as f:
+            previous, total = None, 0
+            for instance, count in heapq.merge(*[ readrun(runfile) for runfile in runs ]):
+                if instance != previous:
+                    if previous is not None:
+                        f.write(self._addweight(previous, total) + "\n")
+                        unique += 1
+                    previous, total = instance, 0
+                total += count
+            if previous is not None:
+                f.write(self._addweight(previous, total) + "\n")
+                unique += 1
+        os.replace(filename + ".tmp", filename)
+        for runfile in self.runs:
+            os.unlink(runfile)
+        self.runs = []
+        self.flushed = unique
+        self.aggregated = True
         return True
 
+    def flush(self, wait=True):
+        """Hands the appended instances to a background thread that writes them to the training file, so appending can go on in the meantime. Unless wait is False, waits until everything appended so far has been written and closes the file. If writing fails, an IOError is raised by this or the next flush(); all instances that were not written are kept, so flush() can be retried. With aggregate set, merges the aggregated instances into the training file instead"""
+        if self.debug: print("Flushing...",file=sys.stderr)
+        if self.aggregate:
+            return self._mergeruns()
+        flushed = bool(self.instances)
+        if self.instances:
+            if self.writer is not None and self.writer.error is not None:
+                self._closewriter() #raises the error
+            if self.writer is None:
+                filename = self.flushfile if hasattr(self, 'flushfile') else self.fileprefix + ".train"
+                self.writer = BackgroundWriter(filename, 'a' if self.flushed else 'w', self.encoding)
+            try:
+                self.writer.write(self.instances)
+            except IOError:
+                self._closewriter()
+                raise
+            self.instances = []
+        if wait:
+            self._closewriter()
+        return flushed
+
+    def _closewriter(self):
+        """Waits until the training file writer is done and closes it. If writing failed, the lines it did not write are put back before the appended instances, and an IOError is raised. Mostly for internal use"""
+        writer = self.writer
+        if writer is None:
+            return
+        self.writer = None #a new writer is started, appending, on the next flush
+        try:
+            writer.close()
+        except IOError:
+            self.instances = writer.unwritten() + self.instances
+            raise
+        finally:
+            self.flushed += writer.written
+
     def __delete__(self):
         self.flush()
 
@@ -141,35 +632,389 @@ class TimblClassifier(object):
             else:
                 filepath = self.fileprefix + '.train'
 
+        self._learn(filepath, save)
+
+    def _learn(self, trainfile, save=False, errors=None):
+        """Learns the training file and makes the result the loaded experiment. If the errors list is given and not empty after learning, the data read by TiMBL is incomplete and the first error is raised, before anything is replaced or saved. Mostly for internal use"""
         options = "-F " + self.format + " " +  self.timbloptions
         if self.dist:
             options += " +v+db +v+di"
+        options += self._weightoption() #the counts of aggregated instances are exemplar weights
         print("Calling Timbl API for training: " + options, file=stderr)
-        self.api = timblapi.TimblAPI(options,"")
+        api = timblapi.TimblAPI(options,"")
         if self.debug:
             print("Enabling debug for timblapi",file=stderr)
-            self.api.enableDebug()
+            api.enableDebug()
+        api.enableStats(self.instrument)
 
-        trainfile = filepath
-        self.api.learn(trainfile)
+        learned = api.learn(trainfile)
+        if errors:
+            raise errors[0]
+        if not learned:
+            raise LoadException("TiMBL failed to learn " + trainfile)
         if save:
-            self.save()
+            self._save(api)
         if self.threading:
-            self.api.initthreading()
+            api.initthreading(self.maxclones)
+            self._initpool(api)
+        self._setapi(api) #only now, so other threads do not classify with an experiment that is still learning or being set up for threading
+
+    def train_from(self, instances, save=False, tmpdir=None):
+        """Train directly on (features, classlabel) pairs without writing a training file. The instances are streamed to TiMBL through a named pipe by a writer thread, so serialisation overlaps with learning.
+
+        TiMBL reads its training data more than once. If instances is a callable, it is called for a fresh iterable on every read; a re-iterable such as a list is iterated again; a one-shot iterator is kept in memory after the first read and replayed from there. With aggregate set, every instance is given a weight of 1."""
+        if callable(instances):
+            source = lambda: ( self._addweight(self.formatinstance(features, classlabel, True)) + "\n" for features, classlabel in instances() )
+        elif iter(instances) is not instances:
+            source = lambda: ( self._addweight(self.formatinstance(features, classlabel, True)) + "\n" for features, classlabel in instances )
+        else:
+            cache = []
+            remaining = ( self._addweight(self.formatinstance(features, classlabel, True)) + "\n" for features, classlabel in instances )
+            def source():
+                for line in cache:
+                    yield line
+                for line in remaining:
+                    cache.append(line)
+                    yield line
+
+        fifodir = tempfile.mkdtemp(prefix=os.path.basename(self.fileprefix), dir=tmpdir)
+        fifo = os.path.join(fifodir, 'train')
+        os.mkfifo(fifo)
+        done = Event()
+        errors = []
+
+        def writer():
+            while True:
+                f = io.open(fifo, 'w', encoding=self.encoding) #blocks until TiMBL (or the final wakeup below) opens the pipe
+                if done.is_set():
+                    f.close()
+                    return
+                #a reader is attached, swap in a fresh pipe so TiMBL's next open can never attach to this one
+                os.mkfifo(fifo + '.next')
+                os.replace(fifo + '.next', fifo)
+                try:
+                    if not errors: #after a failure, keep answering with empty input until TiMBL gives up
+                        for line in source():
+                            f.write(line)
+                    f.close()
+                except BrokenPipeError: #TiMBL stopped reading early
+                    try:
+                        f.close()
+                    except BrokenPipeError:
+                        pass
+                except Exception as e: #pylint: disable=broad-except
+                    errors.append(e)
+                    f.close()
+
+        thread = Thread(target=writer, daemon=True)
+        thread.start()
+        try:
+            self._learn(fifo, save, errors) #the writer records a failure before it closes the pipe, so it is known once TiMBL is done
+        finally:
+            done.set()
+            #wake up the writer if it is waiting for another reader
+            wakeup = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+            thread.join()
+            os.close(wakeup)
+            os.unlink(fifo)
+            os.rmdir(fifodir)
 
     def save(self):
         if not self.api:
             raise Exception("No API instantiated, did you train the classifier first?")
-        self.api.writeInstanceBase(self.fileprefix + ".ibase")
-        self.api.saveWeights(self.fileprefix + ".wgt")
+        self._save(self.api)
+
+    def _save(self, api):
+        """Writes the instance base and weights of the given experiment, and the schema. Mostly for internal use"""
+        api.writeInstanceBase(self.fileprefix + ".ibase")
+        api.saveWeights(self.fileprefix + ".wgt")
+        if self.schema is not None and self.schema.compact:
+            self.schema.save(self.fileprefix + ".schema")
+
+    def __getstate__(self):
+        """Pickles the classifier, including the trained instance base and weights, which are serialised in memory (compressed with zlib if picklecompression is set to a compression level)"""
+        self._closewriter()
+        state = dict( (key, value) for key, value in self.__dict__.items() if key not in ('api', 'pool', 'cache', 'cachelock', 'statslock', 'statscallback', 'writer') )
+        state['ibase'] = state['weights'] = None
+        if self.api:
+            #snapshot() also works on the experiment that is disconnected after initthreading()
+            state['ibase'] = _inmemoryfile(lambda path: self.api.snapshot(path, ''))
+            state['weights'] = _inmemoryfile(lambda path: self.api.snapshot('', path))
+            if self.picklecompression:
+                state['ibase'] = zlib.compress(state['ibase'], self.picklecompression)
+                if state['weights'] is not None:
+                    state['weights'] = zlib.compress(state['weights'], self.picklecompression)
+        return state
+
+    def __setstate__(self, state):
+        ibase = state.pop('ibase')
+        weights = state.pop('weights')
+        self.__dict__.update(state)
+        self.api = None
+        self.pool = None
+        self.cache = collections.OrderedDict()
+        self.cachelock = Lock()
+        self.statslock = Lock()
+        self.statscallback = None
+        self.writer = None
+        if ibase is not None:
+            if self.picklecompression:
+                ibase = zlib.decompress(ibase)
+                if weights is not None:
+                    weights = zlib.decompress(weights)
+            self.load(ibase, weights)
 
     def classify(self, features, allowtopdistribution=True):
+        if self.instrument:
+            return self._timedclassify(features, allowtopdistribution)
+
+        features = self.validatefeatures(features)
+
+        if not self.api:
+            self.load()
+
+        return self._cachedclassify(features, allowtopdistribution)
 
+    def _timedclassify(self, features, allowtopdistribution):
+        """Like classify(), but records counts and timings for stats(). Mostly for internal use"""
+        start = time.perf_counter()
         features = self.validatefeatures(features)
+        validated = time.perf_counter()
 
         if not self.api:
             self.load()
 
+        failures = 0
+        try:
+            return self._cachedclassify(features, allowtopdistribution)
+        except ClassifyException:
+            failures = 1
+            raise
+        finally:
+            end = time.perf_counter()
+            self._record(classifications=1, failures=failures, latency=end - start, validate=validated - start, classify=end - validated)
+
+    def _cachedclassify(self, features, allowtopdistribution):
+        """Classifies validated features, going through the cache if there is one. Mostly for internal use"""
+        if not self.cachesize:
+            return self._classify(features, allowtopdistribution)
+
+        key = (tuple(features), allowtopdistribution)
+        with self.cachelock:
+            generation = self.cachegeneration
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.cachehits += 1
+                result = self.cache[key]
+            else:
+                self.cachemisses += 1
+                result = None
+        if result is None:
+            result = self._classify(features, allowtopdistribution)
+            with self.cachelock:
+                if generation == self.cachegeneration:
+                    self.cache[key] = result
+                    self.cache.move_to_end(key)
+                    while len(self.cache) > self.cachesize:
+                        self.cache.popitem(last=False)
+                        self.cacheevictions += 1
+        if self.dist:
+            cls, distribution, distance = result
+            return (cls, dict(distribution), distance) #copy, so callers can not alter the cached distribution
+        return result
+
+    def _record(self, classifications=0, failures=0, batches=0, latency=None, **phases):
+        """Adds to the counters reported by stats() and calls the stats callback when it is due. Mostly for internal use"""
+        with self.statslock:
+            before = self.counters['classifications']
+            self.counters['classifications'] += classifications
+            self.counters['failures'] += failures
+            self.counters['batches'] += batches
+            for phase, seconds in phases.items():
+                self.counters['time'][phase] += seconds
+            if latency is not None:
+                self.counters['latency'][min(int(latency * 1e6).bit_length(), len(self.counters['latency']) - 1)] += 1
+            due = self.statscallback is not None and self.statsinterval and before // self.statsinterval != self.counters['classifications'] // self.statsinterval
+        if due:
+            self.statscallback(self.stats())
+
+    def stats(self):
+        """Returns the statistics collected when the classifier was constructed with instrument=True"""
+        with self.statslock:
+            stats = {
+                'enabled': self.instrument,
+                'classifications': self.counters['classifications'],
+                'failures': self.counters['failures'],
+                'batches': self.counters['batches'],
+                'time': dict(self.counters['time']),
+                'latency': list(self.counters['latency']),
+            }
+        stats['cache'] = self.cacheinfo() if self.cachesize else None
+        stats['native'] = self.api.stats() if self.api else None
+        return stats
+
+    def resetstats(self):
+        """Resets all counters reported by stats()"""
+        with self.statslock:
+            self.counters = {'classifications': 0, 'failures': 0, 'batches': 0, 'time': {'validate': 0.0, 'classify': 0.0}, 'latency': [0] * 32}
+        if self.api:
+            self.api.resetStats()
+
+    def cacheinfo(self):
+        """Returns a dictionary with statistics on the classification cache (see the cachesize parameter)"""
+        with self.cachelock:
+            return {'hits': self.cachehits, 'misses': self.cachemisses, 'evictions': self.cacheevictions, 'size': len(self.cache), 'maxsize': self.cachesize}
+
+    def _setapi(self, api):
+        """Replaces the loaded experiment, which empties the classification cache. Mostly for internal use"""
+        self.api = api
+        self.clearcache()
+        self.instancecount = None
+
+    def clearcache(self):
+        """Empties the classification cache, this is done automatically whenever the model changes through this class"""
+        with self.cachelock:
+            self.cache.clear()
+            self.cachegeneration += 1
+
+    def increment(self, features, classlabel):
+        """Adds a single instance to the loaded instance base"""
+        return not self.learn_incremental([ (features, classlabel) ])
+
+    def decrement(self, features, classlabel):
+        """Removes a single instance from the loaded instance base"""
+        return not self.forget([ (features, classlabel) ])
+
+    def learn_incremental(self, batch):
+        """Adds a batch of (features, classlabel) pairs to the loaded instance base in one native call, without relearning. This is safe while other threads classify: the batch is applied once running classifications are done, and classifications started afterwards see all of it. Note that TiMBL only supports this for IB1 (-a 0), and that feature weights are not recomputed. Returns the indices of the instances that could not be added"""
+        failed = self._update('incrementMany', batch)
+        if self.instancecount is not None:
+            self.instancecount += len(batch) - len(failed)
+        return failed
+
+    def forget(self, batch):
+        """Removes a batch of (features, classlabel) pairs from the loaded instance base in one native call, see learn_incremental(). Returns the indices of the instances that could not be removed"""
+        failed = self._update('decrementMany', batch)
+        if self.instancecount is not None:
+            self.instancecount -= len(batch) - len(failed)
+        return failed
+
+    def _update(self, method, batch):
+        """Applies a batch of changes to the instance base with the named native method, and takes a snapshot when it is due. Mostly for internal use"""
+        if not self.api:
+            self.load()
+        #learned with exemplar weights if aggregate is set, so every line has one, as in the training file
+        lines = [ self._addweight(self.formatinstance(features, classlabel, method == 'incrementMany')) for features, classlabel in batch ]
+        failed = getattr(self.api, method)(lines)
+        self.clearcache()
+        self.updates += len(lines) - len(failed)
+        if self.snapshotinterval and self.updates >= self.snapshotinterval:
+            self.snapshot()
+        return failed
+
+    def snapshot(self):
+        """Writes the instance base and weights as they are now, like save(), but also while other threads classify or learn, and with threading enabled. The files are replaced at once, so a concurrent load() never sees a partially written instance base. This is done automatically every snapshotinterval learned or forgotten instances, if set"""
+        if not self.api:
+            raise Exception("No API instantiated, did you train the classifier first?")
+        ibasefile = self.fileprefix + ".ibase"
+        weightsfile = self.fileprefix + ".wgt"
+        if not self.api.snapshot(ibasefile + ".tmp", weightsfile + ".tmp"):
+            raise IOError("Unable to write snapshot to " + ibasefile + ".tmp")
+        os.replace(ibasefile + ".tmp", ibasefile)
+        os.replace(weightsfile + ".tmp", weightsfile)
+        if self.schema is not None and self.schema.compact:
+            self.schema.save(self.fileprefix + ".schema.tmp")
+            os.replace(self.fileprefix + ".schema.tmp", self.fileprefix + ".schema")
+        self.updates = 0
+
+    def expand(self, filename):
+        """Adds all instances in a file to the loaded instance base"""
+        result = self.api.expand(filename)
+        self.clearcache()
+        self.instancecount = None
+        return result
+
+    def remove(self, filename):
+        """Removes all instances in a file from the loaded instance base"""
+        result = self.api.remove(filename)
+        self.clearcache()
+        self.instancecount = None
+        return result
+
+    def memory(self):
+        """Returns the size of the loaded instance base"""
+        if not self.api:
+            self.load()
+        if self.instancecount is None:
+            trainfile = self.flushfile if hasattr(self, 'flushfile') else self.fileprefix + ".train"
+            if os.path.exists(trainfile):
+                with io.open(trainfile, 'r', encoding=self.encoding) as f:
+                    self.instancecount = sum( self._stripweight(line.rstrip("\n"))[1] for line in f if line.strip() )
+        info = self.api.memoryInfo()
+        return {
+            'instances': self.instancecount,
+            'nodes': info.get('nodes'),
+            'bytes': info.get('bytes'),
+            'compression': info.get('compression'),
+        }
+
+    def compact(self, method='condense', heldout=None, maxloss=0.0, batchsize=100, save=True):
+        """Removes redundant or noisy training instances from the loaded instance base"""
+        if method not in ('condense', 'edit'):
+            raise ValueError("Unknown compaction method: " + method)
+        if not self.api:
+            self.load()
+        self.flush()
+        trainfile = self.flushfile if hasattr(self, 'flushfile') else self.fileprefix + ".train"
+        with io.open(trainfile, 'r', encoding=self.encoding) as f:
+            lines = [ line.rstrip("\n") for line in f if line.strip() ]
+        separator = self.delimiter or ' '
+        suffix = separator + "?"
+
+        result = { 'method': method, 'instances': sum( self._stripweight(line)[1] for line in lines ), 'memory_before': self.memory(), 'accuracy_before': None, 'accuracy_after': None, 'reverted': False }
+        if heldout:
+            result['accuracy_before'] = self.evaluate(heldout)['accuracy']
+
+        removed = []
+        noisy = []
+        for i in range(0, len(lines), batchsize):
+            batch = lines[i:i+batchsize]
+            failed = set(self.api.decrementMany(batch))
+            batch = [ line for j, line in enumerate(batch) if j not in failed ]
+            keep = []
+            instances = [ self._stripweight(line)[0] for line in batch ]
+            for line, instance, (ok, cls, _, _) in zip(batch, instances, self._classifymany([ instance.rsplit(separator, 1)[0] + suffix for instance in instances ], 0)):
+                correct = ok and cls == instance.rsplit(separator, 1)[1]
+                if method == 'condense' and correct:
+                    removed.append(line)
+                else:
+                    keep.append(line)
+                    if method == 'edit' and not correct:
+                        noisy.append(line)
+            if keep:
+                self.api.incrementMany(keep)
+        if noisy:
+            failed = set(self.api.decrementMany(noisy))
+            removed = [ line for j, line in enumerate(noisy) if j not in failed ]
+        self.clearcache()
+
+        if heldout:
+            result['accuracy_after'] = self.evaluate(heldout)['accuracy']
+            if result['accuracy_before'] - result['accuracy_after'] > maxloss:
+                self.api.incrementMany(removed)
+                self.clearcache()
+                removed = []
+                result['reverted'] = True
+        result['removed'] = sum( self._stripweight(line)[1] for line in removed )
+        if self.instancecount is not None:
+            self.instancecount -= result['removed']
+        result['memory_after'] = self.memory()
+        if save and removed:
+            self.snapshot()
+        return result
+
+    def _classify(self, features, allowtopdistribution):
+        """Classifies validated features, bypassing the cache. Mostly for internal use"""
         testinstance = self.delimiter.join(features) + (self.delimiter if not self.delimiter == '' else ' ') + "?"
         if self.dist:
             if self.threading:
@@ -194,30 +1039,147 @@ class TimblClassifier(object):
             else:
                 raise ClassifyException("Failed to classify: " + u(testinstance))
 
+    def classify_indexed(self, features, topk=0):
+        """Classify a feature vector, returning the class distribution in compact form rather than as a dictionary: a tuple (class index, class indices, weights, margin, distance). Class indices are fixed for the model and can be mapped to labels with classes(); the indices and weights are arrays, sorted by descending weight and limited to the best topk classes if topk is set. The margin is the difference between the two best weights."""
+        features = self.validatefeatures(features)
+
+        if not self.api:
+            self.load()
+
+        testinstance = self.delimiter.join(features) + (self.delimiter if not self.delimiter == '' else ' ') + "?"
+        result, clsindex, indices, weights, margin, distance = self.api.classifyIndexed(testinstance, self.normalize, topk)
+        if not result:
+            raise ClassifyException("Failed to classify: " + u(testinstance))
+        classindices = array('i')
+        classindices.frombytes(indices)
+        classweights = array('d')
+        classweights.frombytes(weights)
+        return clsindex, classindices, classweights, margin, distance
+
+    def classes(self):
+        """Returns the class labels by the class index used by classify_indexed(), as far as they are known: labels are added as classify_indexed() encounters them, so this list only grows and is not the full set of classes of the model (labels not encountered yet are empty strings or missing)"""
+        return [ u(cls) for cls in self.api.classVocabulary() ]
+
+    def classify_batch(self, batch, allowtopdistribution=True):
+        """Classify a list of feature vectors in one native call. Returns a tuple (results, failed): results holds what classify() would return for each instance (None for instances that could not be classified), failed lists the indices of those instances"""
+        if not self.api:
+            self.load()
+
+        start = time.perf_counter() if self.instrument else None
+        testinstances = self._formatbatch(batch)
+        if start is not None:
+            self._record(validate=time.perf_counter() - start)
+        return self.classify_formatted(testinstances, allowtopdistribution)
+
+    def _formatbatch(self, batch):
+        """Validates and formats a list of feature vectors as test instances. Mostly for internal use"""
+        suffix = (self.delimiter if not self.delimiter == '' else ' ') + "?"
+        if self.schema is not None:
+            return [ line + suffix for line in self.schema.encodebatch(batch) ]
+        return [ self.delimiter.join(self.validatefeatures(features)) + suffix for features in batch ]
+
+    def classify_formatted(self, testinstances, allowtopdistribution=True):
+        """Like classify_batch(), but takes the test instances already formatted as lines in the input format, e.g. by timblapi.formatDense() or timblapi.formatSparse()"""
+        if not self.api:
+            self.load()
+
+        start = time.perf_counter() if self.instrument else None
+        results = []
+        failed = []
+        for i, (result, cls, distribution, distance) in enumerate(self._classifymany(testinstances, int(not allowtopdistribution))):
+            if result:
+                cls = u(cls)
+                if self.dist:
+                    results.append( (cls, distribution, distance) )
+                else:
+                    results.append(cls)
+            else:
+                results.append(None)
+                failed.append(i)
+        if start is not None:
+            self._record(classifications=len(results), failures=len(failed), batches=1, classify=time.perf_counter() - start)
+        return results, failed
+
+    def _classifymany(self, testinstances, requireddepth):
+        """Classifies prepared test instances, split over the thread pool if there is one. Mostly for internal use"""
+        return self._inpool(self.api.classifyMany, testinstances, self.normalize, requireddepth)
+
+    def _inpool(self, method, testinstances, *args):
+        """Calls a native batch method on prepared test instances, split over the thread pool if there is one, and returns the concatenated results. Mostly for internal use"""
+        if self.pool is None or len(testinstances) < 2:
+            return method(testinstances, *args)
+        chunksize = -(-len(testinstances) // self.threads)
+        futures = [ self.pool.submit(method, testinstances[i:i+chunksize], *args) for i in range(0, len(testinstances), chunksize) ]
+        output = []
+        for future in futures:
+            output += future.result()
+        return output
+
+    def neighbours(self, batch):
+        """Returns the nearest neighbours of each feature vector in a list, as data rather than TiMBL's text output. Uses one native call, or one per thread of the pool, on the experiment clones if threading is enabled. For each instance, the result is None if it could not be classified, or else a tuple (distances, distributions). distances is an array with the distance at each k, and distributions is a list with the class distribution (a dictionary) at each k. The feature vectors of the neighbours are not included, as TiMBL does not expose them through its API"""
+        if not self.api:
+            self.load()
+
+        results = []
+        for result, distancebytes, distributions in self._inpool(self.api.neighboursMany, self._formatbatch(batch), self.normalize):
+            if result:
+                distances = array('d')
+                distances.frombytes(distancebytes)
+                results.append( (distances, distributions) )
+            else:
+                results.append(None)
+        return results
+
     def getAccuracy(self):
         if not self.api:
             raise Exception("No API instantiated, did you train and test the classifier first?")
         return self.api.getAccuracy()
 
-    def load(self):
-        if not os.path.exists(self.fileprefix + ".ibase"):
+    def load(self, ibase=None, weights=None):
+        """Loads the saved instance base, or the given serialised instance base (and weights) as produced when pickling"""
+        if ibase is None and not os.path.exists(self.fileprefix + ".ibase"):
             raise LoadException("Instance base '"+self.fileprefix+".ibase' not found, did you train and save the classifier first?")
 
         options = "-F " + self.format + " " +  self.timbloptions
-        self.api = timblapi.TimblAPI(options, "")
+        api = timblapi.TimblAPI(options, "")
         if self.debug:
             print("Enabling debug for timblapi",file=stderr)
-            self.api.enableDebug()
+            api.enableDebug()
+        api.enableStats(self.instrument)
         print("Calling Timbl API : " + options,file=stderr)
-        self.api.getInstanceBase(self.fileprefix + '.ibase')
+        if ibase is None:
+            api.getInstanceBase(self.fileprefix + '.ibase')
+            if self.schema is not None and self.schema.compact and os.path.exists(self.fileprefix + ".schema"):
+                self.schema.read(self.fileprefix + ".schema")
+        else:
+            _inmemoryfile(api.getInstanceBase, ibase)
+            if weights is not None:
+                _inmemoryfile(lambda path: api.getWeights(path, api.currentWeighting()), weights)
         #if os.path.exists(self.fileprefix + ".wgt"):
         #    self.api.getWeights(self.fileprefix + '.wgt')
         if self.threading:
             if self.debug: print("Invoking initthreading()",file=sys.stderr)
-            self.api.initthreading()
+            api.initthreading(self.maxclones)
+            self._initpool(api)
+        self._setapi(api) #only now, see _learn()
+
+    def _initpool(self, api):
+        """Starts the thread pool for batch classification and creates the experiment clones for its threads. Mostly for internal use"""
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        if self.threads > 1:
+            self.pool = ThreadPoolExecutor(max_workers=self.threads)
+            api.prepareClones(self.threads)
+
+    def poolstats(self):
+        """Returns statistics on the pool of experiment clones used for threaded classification (see timblapi.poolStats())"""
+        if not self.threading or not self.api:
+            return {}
+        return self.api.poolStats()
 
     def addinstance(self, testfile, features, classlabel="?"):
-        """Adds an instance to a specific file. Especially suitable for generating test files"""
+        """Adds an instance to a specific file. Especially suitable for generating test files. To add many instances, use testfilewriter() instead"""
 
         features = self.validatefeatures(features)
 
@@ -229,6 +1191,10 @@ class TimblClassifier(object):
         f.write(self.delimiter.join(features) + self.delimiter + classlabel + "\n")
         f.close()
 
+    def testfilewriter(self, testfile, append=True):
+        """Returns a TestFileWriter for adding instances to a specific file in a background thread, for use as a context manager"""
+        return TestFileWriter(self, testfile, append)
+
     def test(self, testfile):
         """Test on an existing testfile and return the accuracy"""
         if not self.api:
@@ -237,35 +1203,251 @@ class TimblClassifier(object):
         return self.api.getAccuracy()
 
 
+    def evaluate(self, testfile, output=False, distributions=False):
+        """Test on an existing testfile, collecting everything in memory in one native pass instead of writing and re-parsing the output file. Returns a dictionary with the lists gold, predicted, distance and (if requested) distribution, the accuracy, the number of failures, the confusion matrix as a dictionary mapping (gold, predicted) to counts, and for each class a tuple (precision, recall, F1, support). The output file is only written if output is True."""
+        if not self.api:
+            self.load()
+        outfile = self.fileprefix + '.out' if output else ''
+        delimiter = "\t" if self.format == "Tabbed" else " \t"
+        return self.api.evaluate(u(testfile), u(outfile), delimiter, self.normalize, distributions)
+
+    def _shard(self, testinstances, processes, chunksize, requireddepth):
+        """Classifies prepared test instances in forked worker processes that share the loaded instance base, yields the results in input order. Mostly for internal use"""
+        global _shardclassifier
+        if not self.api:
+            self.load()
+        testinstances = iter(testinstances)
+        chunks = iter(lambda: list(itertools.islice(testinstances, chunksize)), [])
+        _shardclassifier = self
+        processes = processes or os.cpu_count() or 1
+        pool = multiprocessing.get_context('fork').Pool(processes)
+        try:
+            #a bounded number of chunks in flight, so the input is read only as fast as the results are consumed
+            inflight = collections.deque()
+            for chunk in chunks:
+                inflight.append(pool.apply_async(_classifyshard, ((chunk, requireddepth),)))
+                if len(inflight) >= 2 * processes:
+                    for result in inflight.popleft().get():
+                        yield result
+            while inflight:
+                for result in inflight.popleft().get():
+                    yield result
+        finally:
+            pool.terminate()
+            _shardclassifier = None
+
+    def classify_sharded(self, batch, processes=None, chunksize=1000, allowtopdistribution=True):
+        """Classify an iterable of feature vectors in parallel worker processes, which are forked after loading so they all share a single copy of the instance base. Yields, in input order, what classify() would return for each instance, or None if it could not be classified"""
+        suffix = (self.delimiter if not self.delimiter == '' else ' ') + "?"
+        testinstances = ( self.delimiter.join(self.validatefeatures(features)) + suffix for features in batch )
+        for result, cls, distribution, distance in self._shard(testinstances, processes, chunksize, int(not allowtopdistribution)):
+            if not result:
+                yield None
+            elif self.dist:
+                yield (u(cls), distribution, distance)
+            else:
+                yield u(cls)
+
+    def test_sharded(self, testfile, processes=None, chunksize=1000):
+        """Test on an existing testfile using parallel worker processes that share a single copy of the instance base (see classify_sharded()). Writes the output file like test() does and returns the merged accuracy"""
+        pending = collections.deque()
+        def readlines(f):
+            for line in f:
+                line = line.rstrip("\n")
+                if line.strip():
+                    pending.append(line)
+                    yield line
+
+        correct = total = 0
+        with io.open(testfile, 'r', encoding=self.encoding) as f, io.open(self.fileprefix + '.out', 'w', encoding=self.encoding) as out:
+            for result, cls, distribution, distance in self._shard(readlines(f), processes, chunksize, 0):
+                line = pending.popleft()
+                if not result:
+                    raise ClassifyException("Failed to classify: " + line)
+                cls = u(cls)
+                total += 1
+                if line.rsplit(self.delimiter or ' ', 1)[-1] == cls:
+                    correct += 1
+                if self.dist:
+                    out.write(line + " " + cls + " { " + ", ".join( label + " " + str(score) for label, score in distribution.items() ) + " } " + str(distance) + "\n")
+                else:
+                    out.write(line + " " + cls + "\n")
+        if total == 0:
+            return 0.0
+        return correct / total
+
     def crossvalidate(self, foldsfile):
         """Train & Test using cross validation, testfile is a file that contains the filenames of all the folds!"""
         options = "-F " + self.format + " " +  self.timbloptions + " -t cross_validate"
         print("Instantiating Timbl API : " + options,file=stderr)
-        self.api = timblapi.TimblAPI(options, "")
+        self._setapi(timblapi.TimblAPI(options, ""))
         if self.debug:
             print("Enabling debug for timblapi",file=stderr)
             self.api.enableDebug()
         print("Calling Timbl Test : " + options,file=stderr)
         self.api.test(u(foldsfile),'','')
         a = self.api.getAccuracy()
-        del self.api
+        self._setapi(None)
         return a
 
 
 
+    def crossvalidate_parallel(self, instances=None, folds=10, stratified=False, shuffle=False, seed=None, processes=None, tmpdir=None):
+        """Cross-validation without fold files, with the folds trained and tested in parallel worker processes. The instances are an iterable of (features, classlabel) pairs, which is streamed into the folds unless shuffle is set, or None to use the training file (with aggregate set, each instance as often as its count). With stratified, each class is spread evenly over the folds. Returns a dictionary with a list of per-fold results (fold, size, accuracy, failures, confusion and classes, as in evaluate()), and the aggregated accuracy over all instances, the mean and standard deviation of the fold accuracies, the summed confusion matrix, and (precision, recall, F1, support) per class computed from it"""
+        if folds < 2:
+            raise ValueError("Cross-validation needs at least two folds")
+        if instances is None:
+            self.flush()
+            trainfile = self.flushfile if hasattr(self, 'flushfile') else self.fileprefix + ".train"
+            def readlines():
+                with io.open(trainfile, 'r', encoding=self.encoding) as f:
+                    for line in f:
+                        line = line.rstrip("\n")
+                        if line.strip():
+                            #the folds are plain, so an instance with a weight is repeated
+                            instance, weight = self._stripweight(line)
+                            for _ in range(weight):
+                                yield instance, instance.rsplit(self.delimiter or ' ', 1)[-1]
+            lines = readlines()
+        else:
+            lines = ( (self.formatinstance(features, classlabel, True), classlabel) for features, classlabel in instances )
+        if shuffle:
+            lines = list(lines)
+            random.Random(seed).shuffle(lines)
+
+        workdir = tempfile.mkdtemp(prefix=os.path.basename(self.fileprefix) + ".folds.", dir=tmpdir)
+        try:
+            foldfiles = [ os.path.join(workdir, "fold" + str(i)) for i in range(folds) ]
+            outputs = [ io.open(foldfile, 'w', encoding=self.encoding) for foldfile in foldfiles ]
+            try:
+                perclass = {}
+                for i, (line, classlabel) in enumerate(lines):
+                    if stratified:
+                        #every class starts at another fold, so small classes do not all end up in the first ones
+                        fold = perclass.setdefault(classlabel, len(perclass))
+                        perclass[classlabel] += 1
+                    else:
+                        fold = i
+                    outputs[fold % folds].write(line + "\n")
+            finally:
+                for output in outputs:
+                    output.close()
+
+            options = "-F " + self.format + " " + self.timbloptions
+            delimiter = "\t" if self.format == "Tabbed" else " \t"
+            processes = min(folds, processes or os.cpu_count() or 1)
+            pool = multiprocessing.get_context('fork').Pool(processes)
+            try:
+                results = pool.map(_crossvalidatefold, [ (options, foldfiles, fold, delimiter, self.normalize) for fold in range(folds) ], chunksize=1)
+            finally:
+                pool.terminate()
+        finally:
+            for filename in os.listdir(workdir):
+                os.unlink(os.path.join(workdir, filename))
+            os.rmdir(workdir)
+
+        confusion = collections.Counter()
+        for result in results:
+            confusion.update(result['confusion'])
+        size = sum( result['size'] for result in results )
+        correct = sum( count for (gold, predicted), count in confusion.items() if gold == predicted )
+        mean = sum( result['accuracy'] for result in results ) / folds
+        return {
+            'folds': results,
+            'accuracy': correct / size if size else 0.0,
+            'accuracy_mean': mean,
+            'accuracy_std': math.sqrt(sum( (result['accuracy'] - mean) ** 2 for result in results ) / folds),
+            'confusion': dict(confusion),
+            'classes': _classmetrics(confusion),
+        }
+
+    def search(self, grid, testfile, processes=None):
+        """Evaluates the classifier on a test file for each of a number of option settings, without relearning where possible. The grid is either a dictionary mapping options to lists of values, e.g. {'-k': [1,3,5], '-m': ['O','M'], '-d': ['Z','IL']}, of which all combinations are evaluated, or a list of option strings. The training file is learned once; options that can be changed on a learned experiment (see RUNTIMEOPTIONS) are applied with setOptions(), only settings that need it are relearned. Each setting is evaluated in a worker process forked from the learned experiment. Returns a list with, for each setting in order, a dictionary with the options, accuracy, failures, whether it was relearned, and the seconds spent on (re)configuring (learntime) and testing (testtime)"""
+        global _searchexperiment
+        if isinstance(grid, dict):
+            keys = list(grid)
+            configurations = [ " ".join( key if value is None or value == '' else key + " " + str(value) for key, value in zip(keys, values) ) for values in itertools.product(*( grid[key] for key in keys )) ]
+        else:
+            configurations = list(grid)
+
+        self.flush()
+        trainfile = self.flushfile if hasattr(self, 'flushfile') else self.fileprefix + ".train"
+        baseoptions = "-F " + self.format + " " + self.timbloptions + self._weightoption()
+        api = timblapi.TimblAPI(baseoptions, "")
+        if self.debug:
+            api.enableDebug()
+        if not api.learn(u(trainfile)):
+            raise LoadException("TiMBL failed to learn " + trainfile)
+
+        _searchexperiment = (api, baseoptions, u(trainfile), u(testfile), "\t" if self.format == "Tabbed" else " \t", self.normalize)
+        pool = multiprocessing.get_context('fork').Pool(processes, maxtasksperchild=1)
+        try:
+            return pool.map(_searchconfiguration, configurations, chunksize=1)
+        finally:
+            pool.terminate()
+            _searchexperiment = None
+
     def leaveoneout(self):
         """Train & Test using leave one out"""
         traintestfile = self.fileprefix + '.train'
-        options = "-F " + self.format + " " +  self.timbloptions + " -t leave_one_out"
-        self.api = timblapi.TimblAPI(options, "")
+        options = "-F " + self.format + " " +  self.timbloptions + self._weightoption() + " -t leave_one_out"
+        api = timblapi.TimblAPI(options, "")
         if self.debug:
             print("Enabling debug for timblapi",file=stderr)
-            self.api.enableDebug()
+            api.enableDebug()
+        api.enableStats(self.instrument)
         print("Calling Timbl API : " + options,file=stderr)
-        self.api.learn(u(traintestfile))
+        api.learn(u(traintestfile))
+        self._setapi(api)
         self.api.test(u(traintestfile), u(self.fileprefix + '.out'),'')
         return self.api.getAccuracy()
 
+    def leaveoneout_parallel(self, processes=None, chunksize=None):
+        """Like leaveoneout(), but the training file is split into chunks that are tested in parallel worker processes, which are forked after learning so they all share a single copy of the instance base. The output of all chunks is collected in the same output file, returns the accuracy"""
+        global _leaveoneoutapi
+        traintestfile = self.fileprefix + '.train'
+        outfile = self.fileprefix + '.out'
+        options = "-F " + self.format + " " +  self.timbloptions + self._weightoption() + " -t leave_one_out"
+        api = timblapi.TimblAPI(options, "")
+        if self.debug:
+            print("Enabling debug for timblapi",file=stderr)
+            api.enableDebug()
+        api.enableStats(self.instrument)
+        print("Calling Timbl API : " + options,file=stderr)
+        if not api.learn(u(traintestfile)):
+            raise LoadException("TiMBL failed to learn " + traintestfile)
+        self._setapi(api)
+
+        with io.open(traintestfile, 'r', encoding=self.encoding) as f:
+            lines = [ line for line in f if line.strip() ]
+        processes = processes or os.cpu_count() or 1
+        chunksize = chunksize or max(1, -(-len(lines) // processes))
+        chunks = []
+        for i in range(0, len(lines), chunksize):
+            chunkfile = outfile + ".chunk" + str(len(chunks))
+            with io.open(chunkfile, 'w', encoding=self.encoding) as f:
+                f.writelines(lines[i:i+chunksize])
+            chunks.append( (chunkfile, chunkfile + ".out", len(lines[i:i+chunksize])) )
+        del lines
+
+        _leaveoneoutapi = self.api
+        pool = multiprocessing.get_context('fork').Pool(processes)
+        try:
+            results = pool.map(_leaveoneoutchunk, chunks, chunksize=1)
+            with io.open(outfile, 'wb') as f:
+                for _, chunkoutfile, _ in chunks:
+                    with io.open(chunkoutfile, 'rb') as chunkoutput:
+                        f.write(chunkoutput.read())
+        finally:
+            pool.terminate()
+            _leaveoneoutapi = None
+            for chunkfile, chunkoutfile, _ in chunks:
+                for filename in (chunkfile, chunkoutfile):
+                    if os.path.exists(filename):
+                        os.unlink(filename)
+        total = sum( size for size, _ in results )
+        return sum( size * accuracy for size, accuracy in results ) / total if total else 0.0
+
     def readtestoutput(self):
         if not os.path.exists(self.fileprefix + ".out"):
             raise LoadException("No test output available, expected '" + self.fileprefix + ".out' . Run test() first")
@@ -303,8 +1485,14 @@ class TimblClassifier(object):
                     distribution = None
                     distance = None
 
+                features = " ".join(segments[:endfvec - 2])
+                if self.delimiter:
+                    features = features.split(self.delimiter)
+                else: #sparse, split into (index,value) pairs
+                    features = [ feature + ")" for feature in features.split(")") if feature ]
+
                 #features, referenceclass, predictedclass, distribution, distance
-                yield " ".join(segments[:endfvec - 2]).split(self.delimiter), segments[endfvec - 2], segments[endfvec - 1], distribution, distance
+                yield features, segments[endfvec - 2], segments[endfvec - 1], distribution, distance
         f.close()
 
     def _parsedistribution(self, instance, start=0, end =None):
@@ -330,3 +1518,307 @@ class TimblClassifier(object):
 
         return dist
 
+
+class CascadeClassifier(object):
+    """Two classifiers learned from the same training data: a fast IGTREE tier and an exact k-NN tier (IB1 or TRIBL). Instances are classified by the fast tier first; only when its match in the tree is shallower than mindepth features, or the share of the best class in its distribution is below minconfidence, is the instance passed on to the exact tier. Training instances are added with append() as for TimblClassifier, further keyword arguments are passed to both classifiers"""
+
+    def __init__(self, fileprefix, timbloptions="-a 0 -k 1", fastoptions="-a 1", mindepth=2, minconfidence=0.0, **kwargs):
+        self.exact = TimblClassifier(fileprefix, timbloptions, **kwargs)
+        self.fast = TimblClassifier(fileprefix + ".igtree", fastoptions, **kwargs)
+        self.mindepth = mindepth
+        self.minconfidence = minconfidence
+        self.lock = Lock()
+        self.resetstats()
+
+    def append(self, features, classlabel):
+        self.exact.append(features, classlabel)
+
+    def train(self, save=False):
+        """Learns both tiers from the same training file"""
+        self.exact.train(save)
+        self.fast._learn(self.exact.flushfile if hasattr(self.exact, 'flushfile') else self.exact.fileprefix + ".train", save)
+
+    def save(self):
+        self.exact.save()
+        self.fast.save()
+
+    def load(self):
+        self.exact.load()
+        self.fast.load()
+
+    def classify(self, features, allowtopdistribution=True):
+        """Classify a feature vector, returns the same as TimblClassifier.classify() does"""
+        results, failed = self.classify_batch([features], allowtopdistribution)
+        if failed:
+            raise ClassifyException("Failed to classify: " + repr(features))
+        return results[0]
+
+    def classify_batch(self, batch, allowtopdistribution=True):
+        """Classify a list of feature vectors with one native call per tier, returns the same as TimblClassifier.classify_batch() does"""
+        if not self.fast.api:
+            self.load()
+
+        testinstances = self.fast._formatbatch(batch)
+        results = [ None ] * len(testinstances)
+        uncertain = []
+        for i, (result, cls, distribution, distance) in enumerate(self.fast._classifymany(testinstances, self.mindepth)):
+            #a match that is too shallow is returned as a success without a class
+            if result and cls and (not self.minconfidence or distribution and max(distribution.values()) >= self.minconfidence * sum(distribution.values())):
+                results[i] = (u(cls), distribution, distance) if self.fast.dist else u(cls)
+            else:
+                uncertain.append(i)
+
+        failed = []
+        if uncertain:
+            exactresults, exactfailed = self.exact.classify_formatted([ testinstances[i] for i in uncertain ], allowtopdistribution)
+            for i, result in zip(uncertain, exactresults):
+                results[i] = result
+            failed = [ uncertain[j] for j in exactfailed ]
+
+        with self.lock:
+            self.counters['fast'] += len(testinstances) - len(uncertain)
+            self.counters['exact'] += len(uncertain) - len(failed)
+            self.counters['failed'] += len(failed)
+        return results, failed
+
+    def stats(self):
+        """Returns a dictionary with the number of instances answered by the fast tier (fast), by the exact tier (exact), and that could not be classified (failed), and the share of the fast tier (fastshare)"""
+        with self.lock:
+            stats = dict(self.counters)
+        total = stats['fast'] + stats['exact'] + stats['failed']
+        stats['fastshare'] = stats['fast'] / total if total else 0.0
+        return stats
+
+    def resetstats(self):
+        with self.lock:
+            self.counters = {'fast': 0, 'exact': 0, 'failed': 0}
+
+
+class AsyncTimblClassifier(object):
+    """asyncio front-end to a TimblClassifier. Concurrent classify() calls are collected into micro-batches, which are classified natively (with the Global Interpreter Lock released) in a pool of worker threads, so the event loop is never blocked"""
+
+    def __init__(self, classifier, maxbatchsize=64, maxwait=0.002, workers=None):
+        """Wraps a TimblClassifier. A batch is sent off as soon as it holds maxbatchsize requests or its oldest request has waited maxwait seconds. Use threading=True or threads=n on the classifier to allow more than one worker thread"""
+        self.classifier = classifier
+        self.maxbatchsize = maxbatchsize
+        self.maxwait = maxwait
+        if workers is None:
+            workers = max(1, classifier.threads) if classifier.threading else 1
+        elif workers > 1 and not classifier.threading:
+            raise ValueError("Multiple workers require a TimblClassifier with threading=True")
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = {} #allowtopdistribution => list of (features, test instance, future)
+        self.timers = {}
+        if not self.classifier.api:
+            self.classifier.load()
+
+    async def classify(self, features, allowtopdistribution=True):
+        """Classify a feature vector, returns the same as TimblClassifier.classify() does"""
+        #invalid features only fail this request, not the batch it would be part of
+        testinstance = self.classifier._formatbatch([ features ])[0]
+        future = asyncio.get_running_loop().create_future()
+        batch = self.pending.setdefault(allowtopdistribution, [])
+        batch.append((features, testinstance, future))
+        if len(batch) >= self.maxbatchsize:
+            self._flush(allowtopdistribution)
+        elif allowtopdistribution not in self.timers:
+            self.timers[allowtopdistribution] = asyncio.get_running_loop().call_later(self.maxwait, self._flush, allowtopdistribution)
+        return await future
+
+    def _flush(self, allowtopdistribution):
+        """Sends the pending requests off for classification. Mostly for internal use"""
+        timer = self.timers.pop(allowtopdistribution, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self.pending.pop(allowtopdistribution, [])
+        if batch:
+            task = asyncio.get_running_loop().run_in_executor(self.executor, self.classifier.classify_formatted, [ testinstance for _, testinstance, _ in batch ], allowtopdistribution)
+            task.add_done_callback(lambda task: self._resolve(batch, task))
+
+    @staticmethod
+    def _resolve(batch, task):
+        """Hands the results of a classified batch to the waiting requests. Mostly for internal use"""
+        if task.exception() is not None:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(task.exception())
+            return
+        results, _ = task.result()
+        for (features, _, future), result in zip(batch, results):
+            if future.done(): #cancelled
+                continue
+            if result is None:
+                future.set_exception(ClassifyException("Failed to classify: " + repr(features)))
+            else:
+                future.set_result(result)
+
+    async def close(self):
+        """Classifies all pending requests and shuts down the worker threads"""
+        for allowtopdistribution in list(self.pending):
+            self._flush(allowtopdistribution)
+        await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+def _sendframe(sock, message):
+    #frames are a 4-byte big-endian length followed by a JSON document
+    payload = json.dumps(message).encode('utf-8')
+    sock.sendall(struct.pack('>I', len(payload)) + payload)
+
+def _recvexactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by TiMBL server")
+        data += chunk
+    return data
+
+def _recvframe(sock):
+    size, = struct.unpack('>I', _recvexactly(sock, 4))
+    return json.loads(_recvexactly(sock, size).decode('utf-8'))
+
+
+class TimblServer(object):
+    """Serves one or more loaded classifiers over a Unix or TCP socket, see ``python -m timbl serve --help``.
+
+    Requests and responses are length-prefixed JSON documents; a request holds a batch of instances for one model and clients may pipeline requests, responses are sent in request order. Batches are classified concurrently with the per-thread experiment clones, so the classifiers should be created with threading=True or threads=n"""
+
+    def __init__(self, classifiers, workers=4):
+        """classifiers is a dictionary mapping model names to TimblClassifier instances"""
+        self.classifiers = classifiers
+        for classifier in self.classifiers.values():
+            if not classifier.api:
+                classifier.load()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def _classify(self, request):
+        """Handles a single request, mostly for internal use"""
+        if request.get('model') not in self.classifiers:
+            return {'error': "No such model: " + str(request.get('model'))}
+        classifier = self.classifiers[request['model']]
+        results, failed = classifier.classify_batch(request['instances'], request.get('allowtopdistribution', True))
+        return {'results': results, 'failed': failed}
+
+    async def _handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        responses = asyncio.Queue()
+
+        async def respond():
+            while True:
+                task = await responses.get()
+                if task is None:
+                    break
+                try:
+                    response = await task
+                except Exception as e: #pylint: disable=broad-except
+                    response = {'error': str(e)}
+                payload = json.dumps(response).encode('utf-8')
+                writer.write(struct.pack('>I', len(payload)) + payload)
+                await writer.drain()
+
+        responder = loop.create_task(respond())
+        try:
+            while True:
+                try:
+                    size, = struct.unpack('>I', await reader.readexactly(4))
+                    request = json.loads((await reader.readexactly(size)).decode('utf-8'))
+                except asyncio.IncompleteReadError:
+                    break
+                await responses.put(loop.run_in_executor(self.executor, self._classify, request))
+        finally:
+            await responses.put(None)
+            await responder
+            writer.close()
+
+    async def serve(self, unixsocket=None, host='127.0.0.1', port=7000):
+        """Serves until cancelled, on the given Unix socket if one is specified, otherwise on the given TCP host and port"""
+        if unixsocket:
+            server = await asyncio.start_unix_server(self._handle, path=unixsocket)
+            print("Serving on " + unixsocket, file=stderr)
+        else:
+            server = await asyncio.start_server(self._handle, host, port)
+            print("Serving on " + host + ":" + str(port), file=stderr)
+        async with server:
+            await server.serve_forever()
+
+
+class TimblClient(object):
+    """Client for a TimblServer, offering the classification methods of TimblClassifier for a model loaded by the server"""
+
+    def __init__(self, address, model):
+        """address is the path of a Unix socket, or a (host, port) tuple"""
+        self.model = model
+        if isinstance(address, tuple):
+            self.socket = socket.create_connection(address)
+        else:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(address)
+
+    def _result(self, response):
+        if 'error' in response:
+            raise ClassifyException(response['error'])
+        #JSON turned the result tuples into lists
+        return [ tuple(result) if isinstance(result, list) else result for result in response['results'] ], response['failed']
+
+    def classify(self, features, allowtopdistribution=True):
+        results, failed = self.classify_batch([features], allowtopdistribution)
+        if failed:
+            raise ClassifyException("Failed to classify: " + repr(features))
+        return results[0]
+
+    def classify_batch(self, batch, allowtopdistribution=True):
+        """See TimblClassifier.classify_batch()"""
+        return self.classify_pipelined([batch], allowtopdistribution)[0]
+
+    def classify_pipelined(self, batches, allowtopdistribution=True):
+        """Sends all batches before reading any response, returns a (results, failed) tuple per batch"""
+        for batch in batches:
+            _sendframe(self.socket, {'model': self.model, 'instances': [ list(features) for features in batch ], 'allowtopdistribution': allowtopdistribution})
+        return [ self._result(_recvframe(self.socket)) for _ in batches ]
+
+    def close(self):
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m timbl", description="TiMBL classification server")
+    subparsers = parser.add_subparsers(dest='command')
+    serveparser = subparsers.add_parser('serve', help="Load one or more trained classifiers once and serve them over a socket")
+    serveparser.add_argument('--model', action='append', metavar='NAME:FILEPREFIX:OPTIONS', required=True, help="Model to serve: name, file prefix of the saved instance base, and TiMBL options, separated by colons, e.g. wsd:wsd-bank:-a0 -k1 (repeatable)")
+    serveparser.add_argument('--format', default="Tabbed", help="Input format of the models (Tabbed, Columns or Sparse)")
+    serveparser.add_argument('--unix', help="Listen on this Unix socket rather than on TCP")
+    serveparser.add_argument('--host', default='127.0.0.1', help="TCP host to listen on")
+    serveparser.add_argument('--port', type=int, default=7000, help="TCP port to listen on")
+    serveparser.add_argument('--threads', type=int, default=4, help="Number of concurrent classification threads")
+    args = parser.parse_args()
+    if args.command != 'serve':
+        parser.print_help()
+        return 2
+    classifiers = {}
+    for model in args.model:
+        if model.count(':') < 2:
+            parser.error("--model expects NAME:FILEPREFIX:OPTIONS, got " + model)
+        name, fileprefix, options = model.split(':', 2)
+        classifiers[name] = TimblClassifier(fileprefix, options, format=args.format, threading=True)
+    server = TimblServer(classifiers, workers=args.threads)
+    try:
+        asyncio.run(server.serve(args.unix, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
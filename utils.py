@@ -1,12 +1,14 @@
 from sklearn.base import BaseEstimator, ClassifierMixin
 from sklearn.utils import check_X_y, check_array
-from timbl import TimblClassifier
+from timbl import TimblClassifier, ClassifyException
 import scipy as sp
+import timblapi
 import numpy as np
+import os
 
 class skTiMBL(BaseEstimator, ClassifierMixin):
     def __init__(self, prefix='timbl', algorithm=4, dist_metric=None,
-                 k=1,  normalize=False, debug=0, flushdir=None):
+                 k=1,  normalize=False, debug=0, flushdir=None, n_jobs=1):
         self.prefix = prefix
         self.algorithm = algorithm
         self.dist_metric = dist_metric
@@ -14,6 +16,7 @@ class skTiMBL(BaseEstimator, ClassifierMixin):
         self.normalize = normalize
         self.debug = debug
         self.flushdir = flushdir
+        self.n_jobs = n_jobs
 
 
     def _make_timbl_options(self, *options):
@@ -34,68 +37,86 @@ class skTiMBL(BaseEstimator, ClassifierMixin):
         pass
 
 
+    def _threads(self):
+        """Number of threads used for prediction, following the scikit-learn n_jobs convention"""
+        if self.n_jobs is None:
+            return 1
+        elif self.n_jobs < 0:
+            return max(1, (os.cpu_count() or 1) + 1 + self.n_jobs)
+        return self.n_jobs
+
+
     def fit(self, X, y):
         X, y = check_X_y(X, y, dtype=np.int64, accept_sparse='csr')
 
-        n_rows = X.shape[0]
         self.classes_ = np.unique(y)
 
+        labels = [str(c) for c in y]
+
         if sp.sparse.issparse(X):
             if self.debug: print('Features are sparse, choosing faster learning')
 
             self.classifier = TimblClassifier(self.prefix, "-a{} -k{} -N{} -vf".format(self.algorithm,self.k, X.shape[1]),
                                               format='Sparse', debug=True, sklearn=True, flushdir=self.flushdir,
-                                              flushthreshold=20000, normalize=self.normalize)
+                                              flushthreshold=20000, normalize=self.normalize, threads=self._threads())
 
-            for i in range(n_rows):
-                sparse = ['({},{})'.format(i+1, c) for i,c in zip(X[i].indices, X[i].data)]
-                self.classifier.append(sparse,str(y[i]))
+            written = timblapi.writeSparse(self.classifier.flushfile, X.data, X.indices, X.indptr, labels, False)
 
         else:
 
             self.classifier = TimblClassifier(self.prefix, "-a{} -k{} -N{} -vf".format(self.algorithm, self.k, X.shape[1]),
                                               debug=True, sklearn=True, flushdir=self.flushdir, flushthreshold=20000,
-                                              normalize=self.normalize)
+                                              normalize=self.normalize, threads=self._threads())
 
-            if y.dtype != 'O':
-                y = y.astype(str)
+            written = timblapi.writeDense(self.classifier.flushfile, np.ascontiguousarray(X), labels, self.classifier.delimiter, False)
 
-            for i in range(n_rows):
-                self.classifier.append(list(X[i].toarray()[0]), y[i])
+        if not written:
+            raise IOError("Unable to write training data to " + self.classifier.flushfile)
 
         self.classifier.train()
         return self
 
 
-    def _timbl_predictions(self, X, part_index, y=None):
-        choices = {0 : lambda x : x.append(np.int64(label)),
-                   1 : lambda x : x.append([np.float(distance)]),
-                  }
-        X = check_array(X, dtype=np.float64, accept_sparse='csr')
+    def _timbl_instances(self, X):
+        """Formats every row of X as a test instance in one native pass"""
+        if sp.sparse.issparse(X):
+            return timblapi.formatSparse(X.data, X.indices, X.indptr)
+        else:
+            return timblapi.formatDense(np.ascontiguousarray(X), self.classifier.delimiter)
 
-        n_samples = X.shape[0]
 
-        pred = []
-        func = choices[part_index]
-        if sp.sparse.issparse(X):
-            if self.debug: print('Features are sparse, choosing faster predictions')
+    def _timbl_predictions(self, X):
+        """
+        Classifies all rows of X in a single batch and returns a tuple of
+        the predicted labels, the class probabilities (columns aligned with
+        classes_) and the distances.
+        """
+        X = check_array(X, dtype=np.int64, accept_sparse='csr')
+        if self.debug and sp.sparse.issparse(X): print('Features are sparse, choosing faster predictions')
 
-            for i in range(n_samples):
-                sparse = ['({},{})'.format(i+1, c) for i,c in zip(X[i].indices, X[i].data)]
-                label,proba, distance = self.classifier.classify(sparse)
-                func(pred)
+        results, failed = self.classifier.classify_formatted(self._timbl_instances(X))
+        if failed:
+            raise ClassifyException("Failed to classify {} of {} instances, first failure at row {}".format(len(failed), len(results), failed[0]))
 
-        else:
-            for i in range(n_samples):
-                label,proba, distance = self.classifier.classify(list(X[i].toarray()[0]))
-                func(pred)
+        classindex = dict((str(c), j) for j, c in enumerate(self.classes_))
+        labels = np.empty(len(results), dtype=self.classes_.dtype)
+        proba = np.zeros((len(results), len(self.classes_)), dtype=np.float64)
+        distances = np.empty(len(results), dtype=np.float64)
+        for i, (label, distribution, distance) in enumerate(results):
+            labels[i] = self.classes_[classindex[label]]
+            for classlabel, score in distribution.items():
+                if classlabel in classindex:
+                    proba[i, classindex[classlabel]] = score
+            distances[i] = distance
 
-        return np.array(pred)
+        totals = proba.sum(axis=1, keepdims=True)
+        totals[totals == 0] = 1
+        return labels, proba / totals, distances
 
 
 
     def predict(self, X, y=None):
-        return self._timbl_predictions(X, part_index=0)
+        return self._timbl_predictions(X)[0]
 
 
     def predict_proba(self, X, y=None):
@@ -108,8 +129,11 @@ class skTiMBL(BaseEstimator, ClassifierMixin):
         instead of a probabilistic continuum such as classifiers that can give
         a probability estimation (e.g. Linear classifiers). For an explanation,
         see Fawcett (2005).
+
+        The probabilities returned are the normalised TiMBL class
+        distributions, with columns aligned with classes_.
         """
-        return predict(X)
+        return self._timbl_predictions(X)[1]
 
 
     def decision_function(self, X, y=None):
@@ -117,6 +141,15 @@ class skTiMBL(BaseEstimator, ClassifierMixin):
         The decision function is interpreted here as being the distance between
         the instance that is being classified and the nearest point in k space.
         """
-        return self._timbl_predictions(X, part_index=1)
+        return self._timbl_predictions(X)[2]
+
+
+    def predict_all(self, X):
+        """
+        Returns the labels, class probabilities and distances for X, as
+        predict(), predict_proba() and decision_function() would, but
+        obtained in a single pass over the data.
+        """
+        return self._timbl_predictions(X)
 
 